@@ -0,0 +1,169 @@
+from __future__ import print_function
+
+import asyncio
+import logging
+import socket
+
+import paho.mqtt.client as mqtt
+
+
+class AsyncRunner(object):
+    """
+    Runs the serial I/O, the Inventum state machine and the MQTT client on one asyncio event loop.
+
+    The workflow of every unit is stepped when data arrives on its serial port, when an MQTT command was handled
+    (wakeup) and when the next timer of its state machine is due. The MQTT client is
+    driven through paho's socket callbacks instead of its own network thread, so its callbacks run on the loop as
+    well.
+    """
+
+    POLL_INTERVAL = 0.1  # for ports without a file descriptor
+    RECONNECT_MIN = 1  # seconds before the first attempt to reconnect to the broker, doubled up to RECONNECT_MAX
+    RECONNECT_MAX = 60
+    DRAIN_TIMEOUT = 5.0  # seconds the last messages get to reach the broker at shutdown
+
+    def __init__(self, client):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.events = set()
+        self.client = client
+        self.misc = None
+        self.closed = None
+
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self.misc is None:
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.closed is not None:
+            self.closed.set()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # Keep alive pings, retries and reconnecting to the broker, what loop_start() would do in its thread
+        delay = self.RECONNECT_MIN
+        try:
+            while True:
+                if self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                    delay = self.RECONNECT_MIN
+                    await asyncio.sleep(1)
+                    continue
+                logging.warning('MQTT connection lost, reconnecting in %d s', delay)
+                await asyncio.sleep(delay)
+                try:
+                    # Opens a new socket, on_socket_open registers it with the loop
+                    self.client.reconnect()
+                except (socket.error, OSError) as e:
+                    logging.error('MQTT reconnect failed: %s', e)
+                    delay = min(delay * 2, self.RECONNECT_MAX)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.misc = None
+
+    def wakeup(self):
+        for event in self.events:
+            event.set()
+
+    @staticmethod
+    async def wait(event, timeout):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    async def serve(self, inventum):
+        event = asyncio.Event()
+        self.events.add(event)
+        termser = inventum.termser
+        # The reader thread fills the ring buffer, have it wake up the loop
+        termser.on_receive = lambda: self.loop.call_soon_threadsafe(event.set)
+        # A stalled port must not hold up the loop of all units, keys it does not take wait for add_writer
+        termser.set_nonblocking()
+        inventum.begin()
+
+        fd = None
+        port = None
+        writing = None
+        try:
+            while inventum.run_once():
+                # Register the descriptor again when the port was reopened after it was lost
+                if termser.serial is not port:
+                    if fd is not None:
+                        self.loop.remove_reader(fd)
+                    if writing is not None:
+                        self.loop.remove_writer(writing)
+                        writing = None
+                    port = termser.serial
+                    fd = termser.fileno() if port is not None else None
+                    if fd is not None:
+                        self.loop.add_reader(fd, event.set)
+
+                wfd = termser.write_fileno() if termser.write_pending else None
+                if wfd != writing:
+                    if writing is not None:
+                        self.loop.remove_writer(writing)
+                    writing = wfd
+                    if writing is not None:
+                        self.loop.add_writer(writing, event.set)
+
+                # Sleep until data arrives or the next timer of the state machine is due
+                if fd is not None or termser.reader is not None or not termser.connected:
+                    await self.wait(event, inventum.timeout())
+                else:
+                    await self.wait(event, min(inventum.timeout(), self.POLL_INTERVAL))
+        except Exception as e:
+            # Anything but a lost port only stops this unit
+            logging.exception('Unit failed: %s', e)
+        finally:
+            self.events.discard(event)
+            if fd is not None:
+                self.loop.remove_reader(fd)
+            if writing is not None:
+                self.loop.remove_writer(writing)
+            inventum.finish_profiles()
+            termser.close()
+
+    async def stop(self, on_stop):
+        """
+        Send the last messages and disconnect. paho only queues what is published, the loop has to keep running
+        until it went out.
+        """
+        deadline = self.loop.time() + self.DRAIN_TIMEOUT
+        info = on_stop() if on_stop else None
+        while info is not None and not info.is_published() and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+
+        # No reconnect after the disconnect
+        if self.misc is not None:
+            self.misc.cancel()
+            await asyncio.gather(self.misc, return_exceptions=True)
+
+        self.closed = asyncio.Event()
+        if self.client.disconnect() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.wait_for(self.closed.wait(), max(0.0, deadline - self.loop.time()))
+            except asyncio.TimeoutError:
+                logging.warning('MQTT disconnect did not complete in %d s', self.DRAIN_TIMEOUT)
+
+    def run(self, inventums, on_stop=None):
+        """
+        Serve the units until they stopped, then call 'on_stop' on the loop for the last messages, it returns the
+        MQTTMessageInfo of the last one to wait for (or None).
+        """
+        self.loop.run_until_complete(asyncio.gather(*[self.serve(inventum) for inventum in inventums],
+                                                    return_exceptions=True))
+        self.loop.run_until_complete(self.stop(on_stop))
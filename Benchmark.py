@@ -0,0 +1,602 @@
+#!/usr/bin/python -tt
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import DataLogger
+import Encoding
+import Inventum
+import Publisher
+import Rules
+import Scheduler
+import Simulator
+import Store
+import TermSerial
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def best_of(func, repeat=3):
+    """
+    Run func 'repeat' times and return the fastest run in seconds together with the result of that run.
+    """
+    best = None
+    for _ in range(repeat):
+        start = clock()
+        result = func()
+        elapsed = clock() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, result)
+    return best
+
+
+def sample_stream(records, seed=1):
+    """
+    A captured datalogger session: some left over screen output, the 'Interval' line, header and records.
+    """
+    rnd = random.Random(seed)
+    header, num_fields = Simulator.sample_header()
+    values = Simulator.sample_values(num_fields, rnd)
+    lines = [b'\033[2J\033[1;1H EXTRAMENU\r\n', Simulator.sample_marker(), header]
+    lines += [Simulator.sample_record(values, rnd) for _ in range(records)]
+    return b''.join(lines)
+
+
+def sample_records(records):
+    return DataLogger.DataLoggerParser().feed(sample_stream(records))
+
+
+def sample_menu_session():
+    """
+    Terminal output of a session on the simulated unit: login, extra menu, walking the IO status menu up and down,
+    changing '3-standen' and going back. Returned as the chunks the unit sent per key.
+    """
+    device = Simulator.EcolutionDevice(rate=0)
+    keys = [b'\033', b'3', b'8', b'4', b'5', b'\r', b'1', b'9', b'\r', b'6']
+    keys += [b'\033[B'] * (len(Simulator.IO_MENU) - 1) + [b'\033[A'] * (len(Simulator.IO_MENU) - 1)
+    keys += [b'\033[B'] * 16 + [b'\r', b'3', b'\r', b'\033', b'\033']
+    chunks = [device.take()]
+    for key in keys:
+        device.receive(key)
+        chunks.append(device.take())
+    return chunks
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class CountingClient(object):
+    """
+    Stands in for the MQTT client and counts the publish calls and the bytes they would put on the wire.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not isinstance(payload, bytes):
+            payload = str(payload).encode('utf-8')
+        # PUBLISH packet: fixed header, topic length, topic, packet id for QoS > 0 and the payload
+        self.calls += 1
+        self.bytes += 2 + 2 + len(topic) + (2 if qos else 0) + len(payload)
+
+    def is_connected(self):
+        return False
+
+
+class LoopbackPort(object):
+    """
+    Serial port stand-in: reads return the bytes queued in 'rx', writes are dropped.
+    """
+
+    def __init__(self):
+        self.rx = bytearray()
+
+    def inWaiting(self):
+        return len(self.rx)
+
+    def read(self, size=1):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def flushInput(self):
+        self.rx = bytearray()
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LoopbackTermSerial(TermSerial.TermSerial):
+    @staticmethod
+    def _get_serial(device, baudrate, parity, timeout):
+        return LoopbackPort()
+
+
+class Message(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class SimulatedClock(object):
+    """
+    Time of the simulated unit and the Inventum timers, moved by run_simulated().
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulated_inventum(clock=None):
+    """
+    An Inventum connected to the in-process simulator, stepped until it is reading the datalogger. With a
+    SimulatedClock its timers and the unit run on that clock.
+    """
+    scheduler = None if clock is None else Scheduler.Scheduler(clock)
+    inventum = Inventum.Inventum(logging.getLogger('benchmark'), 'sim://', 20, scheduler=scheduler)
+    if clock is not None:
+        inventum.termser.serial.device.clock = clock
+    inventum.termser.reset()
+    inventum.termser.key_escape()
+    ticks = 0
+    while inventum._current_state != Inventum.Inventum.STATE_DATALOGGER:
+        inventum.termser.running()
+        inventum.step()
+        ticks += 1
+        assert ticks < 100, 'simulated unit did not reach the datalogger'
+    return inventum
+
+
+def bench_datalogger(records=20000, chunk_size=64):
+    stream = sample_stream(records)
+    chunks = chunked(stream, chunk_size)
+
+    def run():
+        parser = DataLogger.DataLoggerParser()
+        return sum(len(parser.feed(chunk)) for chunk in chunks)
+
+    elapsed, parsed = best_of(run)
+    assert parsed == records, 'parsed %d of %d records' % (parsed, records)
+    print('datalogger: %d records, %d bytes in %.3fs: %.0f records/s, %.2f MB/s' % (
+        parsed, len(stream), elapsed, parsed / elapsed, len(stream) / elapsed / 1e6))
+    return {'records_per_second': parsed / elapsed, 'bytes_per_second': len(stream) / elapsed}
+
+
+def bench_datalogger_read(records=5000, chunk_size=256):
+    """
+    Records per second through Inventum's datalogger workflow, one serial read worth of bytes per tick.
+    """
+    chunks = chunked(sample_stream(records), chunk_size)
+
+    def run():
+        inventum = simulated_inventum()
+        received = []
+        inventum.on_data = received.append
+        for chunk in chunks:
+            inventum.termser.raw += chunk
+            inventum.handle_workflow()
+        return len(received)
+
+    elapsed, parsed = best_of(run)
+    assert parsed == records, 'parsed %d of %d records' % (parsed, records)
+    print('datalogger_read: %d records in %.3fs: %.0f records/s' % (parsed, elapsed, parsed / elapsed))
+    return {'records_per_second': parsed / elapsed}
+
+
+def bench_screen(redraws=2000):
+    screens = [Simulator.io_status_screen(item) for item in range(1, len(Simulator.IO_MENU) + 1)]
+    total = sum(len(screens[i % len(screens)]) for i in range(redraws))
+
+    def run():
+        term = LoopbackTermSerial('loopback')
+        for i in range(redraws):
+            term.serial.rx += screens[i % len(screens)]
+            term.running()
+        return term
+
+    elapsed, term = best_of(run)
+    assert int(term.selected_row().strip()[1:3]) == 1 + (redraws - 1) % len(Simulator.IO_MENU)
+    print('screen: %d menu redraws, %d bytes in %.3fs: %.0f redraws/s, %.0f bytes/s' % (
+        redraws, total, elapsed, redraws / elapsed, total / elapsed))
+    return {'redraws_per_second': redraws / elapsed, 'bytes_per_second': total / elapsed}
+
+
+def bench_terminal(sessions=200):
+    """
+    TermSerial.running() on the recorded traffic of a menu session, one read per chunk the unit sent.
+    """
+    chunks = sample_menu_session()
+    total = sum(len(chunk) for chunk in chunks) * sessions
+
+    def run():
+        term = LoopbackTermSerial('loopback')
+        for _ in range(sessions):
+            for chunk in chunks:
+                term.serial.rx += chunk
+                term.running()
+
+    elapsed, _ = best_of(run)
+    print('terminal: %d sessions, %d bytes in %.3fs: %.0f bytes/s' % (sessions, total, elapsed, total / elapsed))
+    return {'bytes_per_second': total / elapsed}
+
+
+def bench_store(records=20000, segment_size=256 << 10, queries=200):
+    """
+    Appending records to the time-series store, then time-range queries of a few fields over it.
+    """
+    data = sample_records(records)
+    fields = ['Temp_buiten', 'Temp_afvoer', '3-standen']
+    directory = tempfile.mkdtemp(prefix='inventum-store-')
+    try:
+        def write():
+            shutil.rmtree(directory)
+            store = Store.TimeSeriesStore(directory, segment_size, 0)
+            for i, record in enumerate(data):
+                store.append(record, i * 10.0)
+            return store
+
+        write_elapsed, store = best_of(write)
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        def read():
+            rows = 0
+            for i in range(queries):
+                start = (i * 97 % records) * 10.0
+                rows += len(store.query(start, start + 3600, fields))
+            return rows
+
+        read_elapsed, rows = best_of(read)
+        store.close()
+    finally:
+        shutil.rmtree(directory)
+
+    assert rows == queries * 360 - sum(max(0, (i * 97 % records) + 360 - records) for i in range(queries))
+    print('store: %d records, %d bytes (%.0f bytes/record): %.0f records/s written, %.0f rows/s queried' % (
+        records, size, size / float(records), records / write_elapsed, rows / read_elapsed))
+    return {'write_records_per_second': records / write_elapsed, 'query_rows_per_second': rows / read_elapsed,
+            'bytes_per_record': size / float(records)}
+
+
+def bench_encoding(records=2000):
+    """
+    Encode cost and payload size per record of every payload encoding, against the nested JSON of json.dumps.
+    Encodings whose package is not installed are skipped.
+    """
+    data = sample_records(records)
+    results = {}
+    print('encoding: %d records' % records)
+    for name in sorted(Encoding.ENCODERS):
+        try:
+            encoder = Encoding.create(name)
+        except ValueError as e:
+            print('  %-8s skipped: %s' % (name, e))
+            continue
+
+        def run():
+            return sum(len(encoder.encode(record)) for record in data)
+
+        elapsed, size = best_of(run)
+        print('  %-8s %7.1f us/record  %6.0f bytes/record' % (name, elapsed / records * 1e6, size / float(records)))
+        results[name] = {'us_per_record': elapsed / records * 1e6, 'bytes_per_record': size / float(records)}
+    return results
+
+
+def bench_publish(records=360, interval=10):
+    """
+    MQTT traffic of every publish mode for records arriving every 'interval' seconds on a simulated clock, so the
+    heartbeat of changes and the aggregate windows come due as they would on the unit.
+    """
+    data = sample_records(records)
+    minutes = records * interval / 60.0
+    publishers = [
+        ('full', lambda c, s: Publisher.FullPublisher(c, 'ventilation/inventum')),
+        ('changes', lambda c, s: Publisher.ChangePublisher(c, 'ventilation/inventum', heartbeat=300, clock=s.clock)),
+        ('batch_json', lambda c, s: Publisher.BatchPublisher(c, 'ventilation/inventum', 6, 0, 'json', scheduler=s)),
+        ('batch_binary', lambda c, s: Publisher.BatchPublisher(c, 'ventilation/inventum', 6, 0, 'binary', scheduler=s)),
+        ('batch_zlib', lambda c, s: Publisher.BatchPublisher(c, 'ventilation/inventum', 6, 0, 'zlib', scheduler=s)),
+        ('aggregate', lambda c, s: Publisher.AggregatePublisher(c, 'ventilation/inventum', [60, 3600], scheduler=s)),
+    ]
+
+    results = {}
+    print('publish: %d records, one every %ds' % (records, interval))
+    for name, factory in publishers:
+        client = CountingClient()
+        sim_clock = SimulatedClock()
+        scheduler = Scheduler.Scheduler(sim_clock)
+        publisher = factory(client, scheduler)
+        start = clock()
+        for record in data:
+            sim_clock.now += interval
+            scheduler.run_due()
+            publisher.publish(record)
+        publisher.flush()
+        elapsed = clock() - start
+        print('  %-13s %8d bytes  %6.1f calls/min  %7.0f bytes/min  %6.1f us/record' % (
+            name, client.bytes, client.calls / minutes, client.bytes / minutes, elapsed / records * 1e6))
+        results[name] = {'bytes_per_minute': client.bytes / minutes, 'calls_per_minute': client.calls / minutes,
+                         'us_per_record': elapsed / records * 1e6}
+    return results
+
+
+def bench_on_data(records=2000):
+    """
+    Cost of InventumUnit.on_data, from parsed record to the MQTT publish call.
+    """
+    import Program
+
+    data = sample_records(records)
+    unit = Program.InventumUnit('inventum', CountingClient(), 'ventilation/inventum')
+    unit.publisher = Publisher.FullPublisher(unit.client, unit.topic)
+
+    def run():
+        for record in data:
+            unit.on_data(record)
+
+    elapsed, _ = best_of(run)
+    print('on_data: %d records in %.3fs: %.1f us/record' % (records, elapsed, elapsed / records * 1e6))
+    return {'us_per_record': elapsed / records * 1e6}
+
+
+def run_simulated(inventum, clock, done, baudrate=9600, limit=1000):
+    """
+    Step 'inventum' the way its loop does until done(), on the simulated 'clock': the bytes read take the time they
+    need at 'baudrate' and when the unit has nothing to send the loop sleeps until the next timer. Returns the
+    simulated seconds and the steps it took.
+    """
+    device = inventum.termser.serial.device
+    start = clock.now
+    steps = 0
+    while not done():
+        read = inventum.termser.bytes_read
+        inventum.run_once()
+        steps += 1
+        assert steps < limit, 'simulated unit did not get there'
+        clock.now += (inventum.termser.bytes_read - read) * 10.0 / baudrate
+        if not device.output and not done():
+            clock.now += inventum.timeout()
+    return clock.now - start, steps
+
+
+def bench_fan_latency(commands=5):
+    """
+    From a FAN=1 command in InventumProcessor.on_message until the simulated unit has '3-standen' set to 3.
+    Reports the simulated time that takes (timers and the bytes at 9600 baud), the workflow steps and the CPU time.
+    """
+    import Program
+
+    latencies = []
+    steps = []
+    elapsed = []
+    for _ in range(commands):
+        processor = Program.InventumProcessor()
+        processor.client = CountingClient()
+        processor.client.subscribe = lambda topic: None
+        unit = Program.InventumUnit('inventum', processor.client, 'ventilation/inventum')
+        sim_clock = SimulatedClock()
+        unit.inventum = simulated_inventum(sim_clock)
+        unit.inventum.commands = unit.commands
+        processor.subscribe(unit.topic + '/commands', unit.on_command)
+        device = unit.inventum.termser.serial.device
+
+        start = clock()
+        processor.on_message(None, None, Message('ventilation/inventum/commands', b'FAN=1'))
+        latency, count = run_simulated(unit.inventum, sim_clock, lambda: device.fan == 3)
+        elapsed.append(clock() - start)
+        latencies.append(latency)
+        steps.append(count)
+
+    mean_latency = sum(latencies) / len(latencies)
+    mean_steps = sum(steps) / float(len(steps))
+    mean_elapsed = sum(elapsed) / len(elapsed)
+    print('fan_latency: %.2fs simulated, %.1f steps, %.2f ms processing' % (
+        mean_latency, mean_steps, mean_elapsed * 1e3))
+    return {'latency_seconds': mean_latency, 'steps': mean_steps, 'processing_ms': mean_elapsed * 1e3}
+
+
+def bench_resume(commands=5):
+    """
+    After a FAN=1 command on the simulated unit: simulated time and workflow steps until the first datalogger record
+    arrives again, and whether the compiled header was reused.
+    """
+    latencies = []
+    steps = []
+    for _ in range(commands):
+        sim_clock = SimulatedClock()
+        inventum = simulated_inventum(sim_clock)
+        device = inventum.termser.serial.device
+        device.rate = 1
+        received = []
+        inventum.on_data = received.append
+        run_simulated(inventum, sim_clock, lambda: received)
+
+        inventum.set_command_fan_high()
+
+        def resumed():
+            if device.fan != 3:
+                del received[:]
+            return received and device.fan == 3
+
+        latency, count = run_simulated(inventum, sim_clock, resumed)
+        latencies.append(latency)
+        steps.append(count)
+
+    mean_latency = sum(latencies) / len(latencies)
+    mean_steps = sum(steps) / float(len(steps))
+    print('resume: %.2fs simulated, %.1f steps from FAN=1 to the next record, %d header cache hits' % (
+        mean_latency, mean_steps, inventum.datalogger.schema_hits))
+    return {'latency_seconds': mean_latency, 'steps': mean_steps}
+
+
+def bench_replay(hours=6, interval=10):
+    """
+    Record a trace of 'hours' of simulated traffic, a record every 'interval' seconds, and replay it as fast as
+    possible through the workflow, timing running() and the rest of the step separately.
+    """
+    directory = tempfile.mkdtemp(prefix='inventum-trace-')
+    path = os.path.join(directory, 'session.trace')
+    try:
+        now = [0.0]
+        inventum = Inventum.Inventum(logging.getLogger('benchmark'), 'sim://', 20)
+        device = inventum.termser.serial.device
+        device.rate = 1.0 / interval
+        device.clock = lambda: now[0]
+        inventum.termser.start_trace(path)
+        inventum.begin()
+        while now[0] < hours * 3600:
+            now[0] += 1.0
+            inventum.termser.running()
+            inventum.step()
+        inventum.termser.close()
+
+        inventum = Inventum.Inventum(logging.getLogger('benchmark'), 'replay:%s?speed=0' % path, 20)
+        port = inventum.termser.serial
+        received = []
+        inventum.on_data = received.append
+        running = step = 0.0
+        inventum.begin()
+        started = clock()
+        while not port.finished:
+            t0 = clock()
+            inventum.termser.running()
+            t1 = clock()
+            inventum.step()
+            step += clock() - t1
+            running += t1 - t0
+        elapsed = clock() - started
+        size = os.path.getsize(path)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    assert received, 'no records replayed'
+    print('replay: %d records (%.0f h, %d byte trace) in %.3fs: %.0fx real time, running() %.3fs, step() %.3fs' % (
+        len(received), hours, size, elapsed, hours * 3600 / elapsed, running, step))
+    return {'records': len(received), 'speedup': hours * 3600 / elapsed, 'running_seconds': running,
+            'step_seconds': step}
+
+
+class ActionCounter(object):
+    """
+    Stands in for Inventum as target of the rule actions.
+    """
+
+    def __init__(self):
+        self.actions = 0
+
+    def set_command_fan_high(self):
+        self.actions += 1
+
+    def set_command_fan_auto(self):
+        self.actions += 1
+
+
+def bench_rules(records=20000):
+    """
+    Evaluating a set of threshold, duration and delta rules on every record, one record every 10 s of simulated
+    time so the durations pass and the rules fire.
+    """
+    data = sample_records(records)
+    options = [('humid', 'Vocht_afvoer > 220 for 60 -> FAN=1'), ('dry', 'Vocht_afvoer < 200 for 600 -> FAN=0'),
+               ('exhaust', 'Temp_afvoer - Temp_buiten >= 290 for 30 -> FAN=1'), ('fan', '3-standen == 3 -> FAN=0')]
+
+    def run():
+        now = [0.0]
+        engine = Rules.create(options, clock=lambda: now[0])
+        target = ActionCounter()
+        for record in data:
+            now[0] += 10
+            engine.evaluate(record, target)
+        return target.actions
+
+    elapsed, actions = best_of(run)
+    print('rules: %d records, %d rules in %.3fs: %.0f records/s, %.2f us per rule, %d actions' % (
+        records, len(options), elapsed, records / elapsed, elapsed / records / len(options) * 1e6, actions))
+    return {'records_per_second': records / elapsed}
+
+
+BENCHMARKS = {
+    'datalogger': bench_datalogger,
+    'datalogger_read': bench_datalogger_read,
+    'encoding': bench_encoding,
+    'fan_latency': bench_fan_latency,
+    'on_data': bench_on_data,
+    'publish': bench_publish,
+    'replay': bench_replay,
+    'resume': bench_resume,
+    'rules': bench_rules,
+    'screen': bench_screen,
+    'store': bench_store,
+    'terminal': bench_terminal,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = flatten(json.load(f)['results'])
+    current = flatten(results)
+    print('\nchange against %s:' % baseline_file)
+    for key in sorted(current):
+        if baseline.get(key):
+            print('  %-40s %12.1f -> %12.1f  %+6.1f%%' % (
+                key, baseline[key], current[key], (current[key] - baseline[key]) * 100.0 / baseline[key]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of the parse, state machine and publish hot paths')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run: %s' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        try:
+            results[name] = BENCHMARKS[name]()
+        except ImportError as e:
+            # on_data and fan_latency need Program and with it the daemonpy submodule
+            print('%s: skipped, %s' % (name, e))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'revision': git_revision(), 'python': platform.python_version(), 'time': time.time(),
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        compare(results, args.compare)
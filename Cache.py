@@ -0,0 +1,47 @@
+from __future__ import print_function
+
+import threading
+import time
+
+
+class LastValueCache(object):
+    """
+    The latest value, status and time of every datalogger field, so they can be answered without waiting for the
+    next record. Updated from the workflow thread, read from the MQTT thread. 'on_change' is called with the
+    names of the fields that changed by an update.
+    """
+
+    def __init__(self, on_change=None):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.updated = None
+        self.on_change = on_change
+
+    def update(self, record, now=None):
+        """
+        Store the fields of 'record' and return the names of the fields whose value or status changed.
+        """
+        now = time.time() if now is None else now
+        changed = []
+        with self.lock:
+            values = self.values
+            for name, value, status in zip(record.schema.names, record.values, record.statuses):
+                last = values.get(name)
+                if last is None or last[0] != value or last[1] != status:
+                    changed.append(name)
+                values[name] = (value, status, now)
+            self.updated = now
+        if changed and self.on_change:
+            self.on_change(changed)
+        return changed
+
+    def entry(self, name):
+        value, status, at = self.values[name]
+        return {"value": value, "status": status, "time": at}
+
+    def get(self, names=None):
+        """
+        {name: {"value", "status", "time"}} of the requested fields, all fields by default. Unknown names are left out.
+        """
+        with self.lock:
+            return dict((name, self.entry(name)) for name in (names or self.values) if name in self.values)
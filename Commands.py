@@ -0,0 +1,203 @@
+from __future__ import print_function
+
+import itertools
+import json
+import logging
+import threading
+
+import Scheduler
+
+
+class Command(object):
+    """
+    A command received over MQTT, e.g. 'FAN=1', waiting in or running from the CommandQueue.
+    """
+    __slots__ = ('id', 'payload', 'name', 'value', 'priority', 'sequence', 'received', 'baseline')
+
+    PRIORITIES = {'PROFILE': -1, 'MEMTRACE': -1, 'QUIT': 0, 'FAN': 1, 'DATA': 2}
+
+    def __init__(self, command_id, payload, sequence, received):
+        self.id = command_id
+        self.payload = payload
+        self.name, _, self.value = payload.partition('=')
+        self.priority = self.PRIORITIES.get(self.name)
+        self.sequence = sequence
+        self.received = received
+        self.baseline = None
+
+    @classmethod
+    def parse(cls, payload, sequence, received):
+        """
+        Plain 'FAN=1' payloads, or JSON {"command": "FAN=1", "id": "..."} to choose the id used in the ack.
+        """
+        command_id = sequence
+        if payload.startswith('{'):
+            request = json.loads(payload)
+            payload = request['command']
+            command_id = request.get('id', sequence)
+        return cls(command_id, payload.strip().upper(), sequence, received)
+
+    def valid(self):
+        if self.name in ('PROFILE', 'MEMTRACE'):
+            return self.value.isdigit()
+        return self.name == 'QUIT' or (self.name in ('FAN', 'DATA') and self.value in ('0', '1'))
+
+    def immediate(self):
+        return self.priority < 0
+
+
+class CommandQueue(object):
+    """
+    Commands between MQTT and Inventum, run one at a time on the workflow thread through poll().
+
+    A new command replaces a pending one of the same kind (the later FAN=x wins), a command that would not change
+    anything on the unit is finished right away and pending commands run in priority order: QUIT, FAN, DATA.
+    PROFILE=<seconds> and MEMTRACE=<seconds> do not touch the unit and start even while another command runs.
+    Every command ends with a call to on_ack with its outcome: done, unchanged, superseded, cancelled, timeout or
+    invalid, and the milliseconds since it was received.
+    """
+
+    TIMEOUT = 120
+
+    def __init__(self, on_ack=None, clock=Scheduler.monotonic):
+        self.on_ack = on_ack
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pending = []
+        self.active = None
+        self.sequence = itertools.count(1)
+
+    def __len__(self):
+        return len(self.pending) + (1 if self.active else 0)
+
+    def __ack(self, command, result):
+        elapsed = int((self.clock() - command.received) * 1000)
+        logging.info('Command %s (%s): %s after %d ms', command.payload, command.id, result, elapsed)
+        if self.on_ack:
+            self.on_ack({'id': command.id, 'command': command.payload, 'result': result, 'ms': elapsed})
+
+    def put(self, payload):
+        try:
+            command = Command.parse(payload, next(self.sequence), self.clock())
+        except (ValueError, KeyError, AttributeError) as e:
+            logging.error('Invalid command %s: %s', payload, e)
+            return None
+
+        if not command.valid():
+            logging.error('Unknown command received: %s', payload)
+            self.__ack(command, 'invalid')
+            return None
+
+        with self.lock:
+            superseded = [c for c in self.pending if c.name == command.name]
+            self.pending = [c for c in self.pending if c.name != command.name]
+            self.pending.append(command)
+            self.pending.sort(key=lambda c: (c.priority, c.sequence))
+
+        for old in superseded:
+            self.__ack(old, 'superseded')
+        return command
+
+    def poll(self, inventum):
+        """
+        Finish the running command when the unit got there, or start the next one. Called from Inventum.step().
+        """
+        self.__poll_immediate(inventum)
+
+        if self.active is not None:
+            result = self.__progress(inventum, self.active)
+            if result is None and self.clock() - self.active.received > self.TIMEOUT:
+                result = 'timeout'
+            if result is None and not (self.pending and self.pending[0].name == 'QUIT'):
+                return
+            self.__ack(self.active, result or 'cancelled')
+            self.active = None
+
+        while self.active is None:
+            command = self.__take(lambda c: True)
+            if command is None:
+                break
+            self.__start(inventum, command)
+
+    def poll_offline(self, inventum):
+        """
+        Called instead of poll() while the serial port is down: only the commands that do not need the unit run,
+        QUIT among them, the others wait for the port to come back.
+        """
+        self.__poll_immediate(inventum)
+
+        command = self.__take(lambda c: c.name == 'QUIT')
+        if command is not None:
+            if self.active is not None:
+                self.__ack(self.active, 'cancelled')
+                self.active = None
+            self.__start(inventum, command)
+
+    def __take(self, predicate):
+        """
+        Remove and return the first pending command when it matches 'predicate', else None. put() runs on the MQTT
+        thread, the check and the removal are one step under the lock.
+        """
+        with self.lock:
+            if self.pending and predicate(self.pending[0]):
+                return self.pending.pop(0)
+        return None
+
+    def __poll_immediate(self, inventum):
+        while True:
+            command = self.__take(Command.immediate)
+            if command is None:
+                break
+            self.__start_profile(inventum, command)
+
+    def __start_profile(self, inventum, command):
+        try:
+            started = inventum.start_profile(command.name, int(command.value))
+        except ValueError as e:
+            logging.error('Command %s: %s', command.payload, e)
+            self.__ack(command, 'invalid')
+            return
+        self.__ack(command, 'done' if started else 'unchanged')
+
+    def __start(self, inventum, command):
+        if command.immediate():
+            # Put in front by put() after __poll_immediate() ran
+            self.__start_profile(inventum, command)
+            return
+
+        if command.name == 'QUIT':
+            inventum.interrupt()
+            self.__ack(command, 'done')
+            with self.lock:
+                cancelled, self.pending = self.pending, []
+            for other in cancelled:
+                self.__ack(other, 'cancelled')
+            return
+
+        if command.name == 'FAN':
+            if (command.value == '1') == (inventum.current_status == 3):
+                self.__ack(command, 'unchanged')
+                return
+            command.baseline = inventum.commands_completed
+            if command.value == '1':
+                inventum.set_command_fan_high()
+            else:
+                inventum.set_command_fan_auto()
+        else:
+            if self.__progress(inventum, command) == 'done':
+                self.__ack(command, 'unchanged')
+                return
+            if command.value == '1':
+                inventum.set_command_data_start()
+            else:
+                inventum.set_command_data_stop()
+        self.active = command
+
+    @staticmethod
+    def __progress(inventum, command):
+        if command.name == 'FAN':
+            return 'done' if inventum.commands_completed != command.baseline else None
+        if command.value == '1':
+            return 'done' if inventum.state == inventum.STATE_DATALOGGER else None
+        return 'done' if inventum.state == inventum.STATE_EXTRA_MENU and \
+            inventum.target_state == inventum.STATE_EXTRA_MENU else None
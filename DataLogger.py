@@ -0,0 +1,225 @@
+from __future__ import print_function
+
+
+def _to_text(value):
+    return value.decode('latin-1').strip()
+
+
+def _infer_converter(value):
+    for converter in (int, float):
+        try:
+            converter(value)
+            return converter
+        except ValueError:
+            pass
+    return _to_text
+
+
+def _status(value):
+    try:
+        return int(value)
+    except ValueError:
+        return _to_text(value)
+
+
+class Column(object):
+    """
+    A single datalogger column: position in the record, sanitised name and the converter for its values.
+    The converter is picked from the first value that is not empty. An int column that gets a fraction becomes a
+    float column, values that fit neither fall back to text.
+    """
+    __slots__ = ('index', 'name', 'status_name', 'converter')
+
+    def __init__(self, index, name, status_name):
+        self.index = index
+        self.name = name
+        self.status_name = status_name
+        self.converter = None
+
+    def convert(self, value):
+        converter = self.converter
+        if converter is None:
+            if not value.strip():
+                return _to_text(value)
+            converter = self.converter = _infer_converter(value)
+        try:
+            return converter(value)
+        except ValueError:
+            pass
+        if converter is int:
+            try:
+                result = float(value)
+            except ValueError:
+                return _to_text(value)
+            self.converter = float
+            return result
+        return _to_text(value)
+
+
+class Schema(object):
+    """
+    Compiled datalogger header. Built once per header instead of once per record.
+    """
+    __slots__ = ('columns', 'names', 'positions')
+
+    def __init__(self, columns):
+        self.columns = tuple(columns)
+        self.names = tuple(c.name for c in self.columns)
+        self.positions = dict((c.name, c.index) for c in self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    @staticmethod
+    def sanitize(name):
+        return name.strip().replace('(', '').replace(')', '').replace(' ', '_').replace('.', '')
+
+    @classmethod
+    def compile(cls, data):
+        hdr = [cls.sanitize(x.decode('latin-1')) for x in data.split(b',')]
+        return cls(Column(i, name, status) for i, (status, name) in enumerate(zip(hdr[0::2], hdr[1::2])))
+
+    def parse(self, line):
+        entries = line.split(b',')
+        if len(entries) < len(self.columns) * 2:
+            return None
+        values = tuple([c.convert(v) for c, v in zip(self.columns, entries[1::2])])
+        statuses = tuple([_status(s) for s in entries[0:len(self.columns) * 2:2]])
+        return Record(self, values, statuses)
+
+
+class Record(object):
+    """
+    One datalogger line as typed values and statuses in schema order. Dict views are only built on request.
+    """
+    __slots__ = ('schema', 'values', 'statuses')
+
+    def __init__(self, schema, values, statuses):
+        self.schema = schema
+        self.values = values
+        self.statuses = statuses
+
+    def __contains__(self, name):
+        return name in self.schema.positions
+
+    def __getitem__(self, name):
+        return self.values[self.schema.positions[name]]
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, name, default=None):
+        idx = self.schema.positions.get(name)
+        return default if idx is None else self.values[idx]
+
+    def status(self, name):
+        return self.statuses[self.schema.positions[name]]
+
+    def items(self):
+        return zip(self.schema.names, self.values)
+
+    def to_dict(self):
+        return dict((name, {"value": value, "status": status})
+                    for name, value, status in zip(self.schema.names, self.values, self.statuses))
+
+
+class DataLoggerParser:
+    """
+    Incremental parser for the Inventum datalogger stream.
+
+    The datalogger starts with an 'Interval' line, followed by a fixed size header with the column names and then
+    one '\\r\\n' terminated line per record. Bytes are fed as they arrive from the serial port, only the new bytes
+    are scanned and every complete record is returned at once.
+
+    Compiled headers are kept across reset() keyed on the header bytes, re-entering the datalogger with the same
+    header reuses the Schema (and the converters it picked) instead of compiling it again.
+    """
+
+    MARKER = b'Interval'
+    MARKER_LENGTH = 21
+    HEADER_LENGTH = 1479
+    TERMINATOR = b'\r\n'
+    SCHEMA_CACHE_SIZE = 4
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.header = None
+        self.synced = False
+        self.malformed = 0
+        self.schemas = {}
+        self.schema_hits = 0
+        self._scan = 0
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.header = None
+        self.synced = False
+        self._scan = 0
+
+    def __schema(self, header):
+        schema = self.schemas.get(header)
+        if schema is not None:
+            self.schema_hits += 1
+            return schema
+        if len(self.schemas) >= self.SCHEMA_CACHE_SIZE:
+            self.schemas.clear()
+        schema = self.schemas[header] = Schema.compile(header)
+        return schema
+
+    def feed(self, data):
+        """
+        Append newly read bytes and return the list of records completed by them.
+        """
+        buf = self.buffer
+        buf += data
+        records = []
+        pos = 0
+
+        while True:
+            if self.header is None:
+                if not self.synced:
+                    idx = buf.find(self.MARKER, max(pos, self._scan - len(self.MARKER) + 1))
+                    if idx == -1:
+                        # Nothing in front of the marker is of any use, only keep a possibly split marker
+                        pos = max(pos, len(buf) - len(self.MARKER) + 1)
+                        self._scan = len(buf)
+                        break
+                    if len(buf) < idx + self.MARKER_LENGTH:
+                        pos = self._scan = idx
+                        break
+                    pos = idx + self.MARKER_LENGTH
+                    self.synced = True
+
+                if len(buf) - pos < self.HEADER_LENGTH + 1:
+                    self._scan = pos
+                    break
+
+                self.header = self.__schema(bytes(buf[pos:pos + self.HEADER_LENGTH]))
+                pos += self.HEADER_LENGTH + 1
+                self._scan = pos
+
+            idx = buf.find(self.TERMINATOR, max(pos, self._scan - 1))
+            if idx == -1:
+                self._scan = len(buf)
+                break
+
+            line = bytes(buf[pos:idx])
+            marker = line.find(self.MARKER)
+            if marker != -1:
+                # The datalogger restarted, sync on the new header
+                pos += marker
+                self.header = None
+                self.synced = False
+                self._scan = pos
+                continue
+
+            pos = self._scan = idx + len(self.TERMINATOR)
+            record = self.header.parse(line)
+            if record is None:
+                self.malformed += 1
+            else:
+                records.append(record)
+
+        del buf[:pos]
+        self._scan = max(0, self._scan - pos)
+        return records
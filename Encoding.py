@@ -0,0 +1,151 @@
+from __future__ import print_function
+
+import json
+import struct
+import zlib
+
+
+class JsonEncoder(object):
+    """
+    The original payload: {"<field>": {"value": <value>, "status": <status>}, ...}
+    """
+
+    def encode(self, record):
+        return json.dumps(record.to_dict())
+
+    def schema(self, record):
+        return None
+
+
+class CompactEncoder(object):
+    """
+    Flat typed values, {"<field>": <value>, ...}. Statuses other than 0 are added under "status".
+    """
+
+    def fields(self, record):
+        data = dict(record.items())
+        statuses = dict((name, status) for name, status in zip(record.schema.names, record.statuses) if status)
+        if statuses:
+            data['status'] = statuses
+        return data
+
+    def encode(self, record):
+        return json.dumps(self.fields(record), separators=(',', ':'))
+
+    def schema(self, record):
+        return None
+
+
+class MsgpackEncoder(CompactEncoder):
+    """
+    The compact fields as MessagePack, needs the msgpack package.
+    """
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ValueError('Payload encoding msgpack needs the msgpack package')
+        self.packb = msgpack.packb
+
+    def encode(self, record):
+        return self.packb(self.fields(record))
+
+
+class CborEncoder(CompactEncoder):
+    """
+    The compact fields as CBOR, needs the cbor2 package.
+    """
+
+    def __init__(self):
+        try:
+            import cbor2
+        except ImportError:
+            raise ValueError('Payload encoding cbor needs the cbor2 package')
+        self.dumps = cbor2.dumps
+
+    def encode(self, record):
+        return self.dumps(self.fields(record))
+
+
+class StructEncoder(object):
+    """
+    Fixed layout per header: a 4 byte schema id followed by a little endian int32 per integer column and a float32
+    per decimal column, in header order. Text columns are left out, a value that could not be converted or does
+    not fit an int32 is sent as MISSING_INT or NaN. The layout follows the header and the converters its columns
+    picked, it is described by the schema message, which is published again when either changes: when the header
+    changes, when an int column becomes a float column or when a column that was empty gets its first value.
+    """
+
+    MISSING_INT = -2 ** 31
+    MAX_INT = 2 ** 31 - 1
+
+    def __init__(self):
+        self.key = None
+        self.layout = None
+
+    @staticmethod
+    def __key(schema):
+        return schema, tuple([column.converter for column in schema.columns])
+
+    def __compile(self, key):
+        schema = key[0]
+        codes = []
+        columns = []
+        for column in schema.columns:
+            if column.converter is int:
+                codes.append('i')
+            elif column.converter is float:
+                codes.append('f')
+            else:
+                continue
+            columns.append(column)
+        fmt = '<I' + ''.join(codes)
+        description = {'format': fmt, 'fields': [c.name for c in columns], 'missing_int': self.MISSING_INT}
+        schema_id = zlib.crc32(json.dumps(description, sort_keys=True).encode('utf-8')) & 0xffffffff
+        description['id'] = schema_id
+        self.key = key
+        self.layout = (struct.Struct(fmt), schema_id, tuple((c.index, codes[i]) for i, c in enumerate(columns)),
+                       json.dumps(description))
+
+    def schema(self, record):
+        """
+        The schema message when it changed with this record, else None.
+        """
+        key = self.__key(record.schema)
+        if key == self.key:
+            return None
+        self.__compile(key)
+        return self.layout[3]
+
+    def encode(self, record):
+        key = self.__key(record.schema)
+        if key != self.key:
+            self.__compile(key)
+        packer, schema_id, columns, _ = self.layout
+        values = record.values
+        packed = []
+        for index, code in columns:
+            value = values[index]
+            if code == 'i':
+                if not isinstance(value, int) or not self.MISSING_INT < value <= self.MAX_INT:
+                    value = self.MISSING_INT
+            elif not isinstance(value, (int, float)):
+                value = float('nan')
+            packed.append(value)
+        return packer.pack(schema_id, *packed)
+
+
+ENCODERS = {
+    'json': JsonEncoder,
+    'compact': CompactEncoder,
+    'msgpack': MsgpackEncoder,
+    'cbor': CborEncoder,
+    'struct': StructEncoder,
+}
+
+
+def create(name):
+    if name not in ENCODERS:
+        raise ValueError('Invalid payload encoding: %s' % name)
+    return ENCODERS[name]()
@@ -1,6 +1,17 @@
 from __future__ import print_function
+import fcntl
+import logging
+import os
+import select
+import tempfile
+import threading
 import time
 
+import Cache
+import DataLogger
+import Metrics
+import Profiling
+import Scheduler
 import TermSerial as Serial
 
 
@@ -25,47 +36,156 @@ class Inventum:
 
     MENU_IO = '6'
     MENU_IO_FAN = 17
+    NAVIGATION_TIMEOUT = 1.0  # seconds without menu movement after a burst of keys before planning again
+    PROGRESS_TIMEOUT = 5.0  # seconds without a known screen in the menus before starting over
+    DATALOGGER_TIMEOUT = 300.0  # seconds without a datalogger record before leaving the datalogger
+    RECONNECT_MIN = 1  # seconds before the first attempt to reopen a lost serial port, doubled per failure
+    RECONNECT_MAX = 60
+    MAX_WAIT = 30.0  # longest sleep of the loop without I/O or a timer, for the command timeouts
+    POLL_INTERVAL = 0.1  # sleep for ports that can not wake the loop up when data arrives
 
     MENU_DATALOGGER = '9'
 
+    FAN_AUTO = 1  # '3-standen' after a reset of the parameter
+
     LOGIN_CODE = '3845'  # Seems to be working for most Inventum Ecolution devices
     PIN_CODE = '19'
 
-    def __init__(self, logger, device, reset_after):
+    # Known screens: (row, text, state, log level, message). Row None is the row with the cursor.
+    # Only rows that changed since the last check are matched, the first match wins.
+    SCREEN_SIGNATURES = (
+        (None, 'Voer code in', STATE_LOGIN, logging.DEBUG, 'Login requested'),
+        (None, 'Voer beveiligingscode in', STATE_CHALLENGE, logging.DEBUG, 'Security code requested'),
+        (2, ' EXTRAMENU', STATE_EXTRA_MENU, logging.INFO, 'Login successful'),
+        (1, 'IO status', STATE_IO_STATUS, logging.DEBUG, 'Activated IO Status menu'),
+        (51, '   3-standen :', STATE_IO_CHANGE_FAN, logging.DEBUG, 'Selected "3-standen" menu item for change'),
+    )
+
+    def __init__(self, logger, device, reset_after, reader_buffer=0, scheduler=None):
         self.log = logger
-        self.termser = Serial.TermSerial(device)
+        self.timers = Scheduler.Scheduler() if scheduler is None else scheduler
+        self.wakeup_event = threading.Event()
+        self.wakeup_pipe = os.pipe()
+        for fd in self.wakeup_pipe:
+            # A burst of wakeups must neither block the caller nor leave wait() with bytes it reads one at a time
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.termser = Serial.TermSerial(device, connect=False)
+        if reader_buffer > 0:
+            self.termser.start_reader(reader_buffer)
+        self.reconnect_delay = self.RECONNECT_MIN
+        self.reconnect_timer = None
+        self.disconnected_at = None
+        self.on_availability = None
         self.datalogger_start = 0
-        self.last_seen = self.millis()
+        self.progress_timer = None
+        self.datalogger_timer = None
         self.last_selected_menu_item = ''
         self.mode = self.MODE_TERM
-        self.datalogger_header = []
-        self.datalogger_buffer = []
+        self.datalogger = DataLogger.DataLoggerParser()
         self.last_line_debug = ''
+        self.screen_generation = -1
         self.reset_timeout = reset_after
 
         self._current_state = self.STATE_IDLE
         self.target_state = self.STATE_DATALOGGER
 
-        self.last_command = self.millis()
+        self.fan_reset_timer = None
+        self.fan_reset_due = False
         self.last_datalogger_entry = self.millis()
         self.current_status = 0
-
+        self.navigation_row = ''
+        self.navigation_timer = None
+        self.command_received = None
+        self.command_latency = None
+        self.commands_completed = 0
+        self.commands = None
+        self.datalogger_wanted = True
+        self.first_record_latency = None
+        self.rules = None
+        self.profiles = []
+        self.profile_prefix = os.path.join(tempfile.gettempdir(), 'inventum')
+        self.on_profile = None
         self._on_data = None
+        self.cache = Cache.LastValueCache()
+        self._metrics = Metrics.NULL
+        self.state_since = Metrics.clock()
+        self.store = None
+        self.__arm_fan_reset()
+
+        try:
+            self.termser.open()
+        except Serial.PORT_ERRORS as e:
+            self.__connection_lost(e)
 
     def __reset__(self):
+        self._metrics.inc('inventum_resets_total')
         self.datalogger_start = 0
-        self.last_seen = self.millis()
+        self.__arm_progress()
         self.last_selected_menu_item = ''
+        self.navigation_row = ''
+        self.__cancel_navigation()
         self.mode = self.MODE_TERM
-        self.datalogger_header = []
-        self.datalogger_buffer = []
+        self.datalogger.reset()
         self.last_line_debug = ''
+        self.termser.mark_dirty()
         self._current_state = self.STATE_IDLE
-        self.target_state = self.STATE_DATALOGGER
+        self.target_state = self.STATE_DATALOGGER if self.datalogger_wanted else self.STATE_EXTRA_MENU
+
+    def millis(self):
+        return int(round(self.timers.clock() * 1000))
 
     @staticmethod
-    def millis():
-        return int(round(time.time() * 1000))
+    def __cancel(timer):
+        if timer is not None:
+            timer.cancel()
+        return None
+
+    def __arm_progress(self):
+        # Every sign of progress in the menus gives the unit another PROGRESS_TIMEOUT seconds
+        self.__cancel(self.progress_timer)
+        self.progress_timer = self.timers.call_later(self.PROGRESS_TIMEOUT, self.__no_progress)
+
+    def __no_progress(self):
+        # Resting in the extra menu after DATA=0 is not stuck, neither is reading the datalogger
+        self.progress_timer = None
+        if self.mode != self.MODE_TERM or self._current_state < self.STATE_EXTRA_MENU or \
+                (self._current_state == self.STATE_EXTRA_MENU and self.target_state == self.STATE_EXTRA_MENU):
+            return
+        self.log.info('No progress in state %s for %d seconds, starting over',
+                      STATE_NAMES.get(self._current_state), self.PROGRESS_TIMEOUT)
+        self.__reset__()
+
+    def __arm_fan_reset(self):
+        self.__cancel(self.fan_reset_timer)
+        self.fan_reset_due = False
+        self.fan_reset_timer = self.timers.call_later(self.reset_timeout * 60, self.__fan_reset_due)
+
+    def __fan_reset_due(self):
+        self.fan_reset_timer = None
+        self.fan_reset_due = True
+
+    def __arm_datalogger_timeout(self, delay):
+        self.__cancel(self.datalogger_timer)
+        self.datalogger_timer = self.timers.call_later(delay, self.__datalogger_timeout)
+
+    def __datalogger_timeout(self):
+        # Records only move last_datalogger_entry, the timer is moved on when it finds one was received since
+        self.datalogger_timer = None
+        if self._current_state != self.STATE_DATALOGGER:
+            return
+        remaining = self.last_datalogger_entry / 1000.0 + self.DATALOGGER_TIMEOUT - self.timers.clock()
+        if remaining > 0:
+            self.__arm_datalogger_timeout(remaining)
+            return
+        self._metrics.inc('inventum_datalogger_timeouts_total')
+        self.__workflow_exit_datalogger()
+
+    def __cancel_navigation(self):
+        self.navigation_timer = self.__cancel(self.navigation_timer)
+
+    def __arm_navigation(self):
+        self.__cancel(self.navigation_timer)
+        self.navigation_timer = self.timers.call_later(self.NAVIGATION_TIMEOUT, self.__cancel_navigation)
 
     @property
     def on_data(self):
@@ -75,29 +195,121 @@ class Inventum:
     def on_data(self, func):
         self._on_data = func
 
+    @property
+    def state(self):
+        return self._current_state
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self._metrics = metrics
+        metrics.add_collector(self.__collect_metrics)
+
+    def __collect_metrics(self, metrics):
+        stats = self.termser.stats()
+        metrics.set('inventum_serial_bytes_total', stats.get('bytes_received', stats['bytes_read']))
+        metrics.set('inventum_serial_writes_total', stats['writes'])
+        metrics.set('inventum_serial_echo_timeouts_total', stats['echo_timeouts'])
+        if 'buffer_occupancy' in stats:
+            metrics.set('inventum_serial_buffer_bytes', stats['buffer_occupancy'])
+            metrics.set('inventum_serial_dropped_bytes_total', stats['bytes_dropped'])
+        metrics.set('inventum_records_malformed_total', self.datalogger.malformed)
+
     def interrupt(self):
         self.termser.interrupt()
+        self.wakeup()
+
+    def __availability(self, online):
+        if self.on_availability:
+            self.on_availability(online)
+
+    def __connection_lost(self, error):
+        self.log.error('Serial port %s lost: %s, reopening in %d s', self.termser.device, error, self.reconnect_delay)
+        self.termser.disconnect()
+        if self.disconnected_at is None:
+            self.disconnected_at = self.timers.clock()
+            self._metrics.inc('inventum_serial_disconnects_total')
+            self.__availability(False)
+        self.__cancel(self.reconnect_timer)
+        self.reconnect_timer = self.timers.call_later(self.reconnect_delay, self.__reconnect)
+
+    def __reconnect(self):
+        self.reconnect_timer = None
+        try:
+            self.termser.reopen()
+        except Serial.PORT_ERRORS as e:
+            self.termser.disconnect()
+            self.reconnect_delay = min(self.reconnect_delay * 2, self.RECONNECT_MAX)
+            self.reconnect_timer = self.timers.call_later(self.reconnect_delay, self.__reconnect)
+            self.log.debug('Reopening %s failed: %s, next attempt in %d s', self.termser.device, e,
+                           self.reconnect_delay)
+            return
+
+        self.log.info('Serial port %s reopened after %.1f s', self.termser.device,
+                      self.timers.clock() - self.disconnected_at)
+        self.reconnect_delay = self.RECONNECT_MIN
+        self.disconnected_at = None
+        self.__reset__()
+        self.begin()
+        self.__availability(True)
 
     def set_command_fan_high(self):
-        self.last_command = self.millis()
+        self.__arm_fan_reset()
         if self.current_status != 3:
+            self.command_received = self.millis()
             self.set_target_state(self.STATE_CMD_FAN_HIGH)
 
     def set_command_fan_auto(self):
-        self.last_command = self.millis()
+        self.__arm_fan_reset()
         if self.current_status == 3:
+            self.command_received = self.millis()
             self.set_target_state(self.STATE_CMD_FAN_RESET)
 
+    def __command_done(self):
+        if self.command_received is not None:
+            self.command_latency = self.millis() - self.command_received
+            self.command_received = None
+            self.commands_completed += 1
+            self.log.info('Fan command completed in %d ms', self.command_latency)
+            self._metrics.observe('inventum_command_seconds', self.command_latency / 1000.0)
+
     def set_command_data_start(self):
+        self.datalogger_wanted = True
         self.set_target_state(self.STATE_DATALOGGER)
 
     def set_command_data_stop(self):
+        self.datalogger_wanted = False
         self.set_target_state(self.STATE_EXTRA_MENU)
 
+    def __resume(self):
+        # Back to where the unit was before a command: the datalogger, unless it was stopped
+        self.set_target_state(self.STATE_DATALOGGER if self.datalogger_wanted else self.STATE_EXTRA_MENU)
+
     def __handle_on_data(self, log_entries):
         self.last_datalogger_entry = self.millis()
+        if self.datalogger_start:
+            self.first_record_latency = self.last_datalogger_entry - self.datalogger_start
+            self.datalogger_start = 0
+            self.log.info('First datalogger record after %d ms', self.first_record_latency)
+            self._metrics.observe('inventum_first_record_seconds', self.first_record_latency / 1000.0)
         if '3-standen' in log_entries:
-            self.current_status = int(log_entries['3-standen']['value'])
+            self.current_status = log_entries['3-standen']
+
+        self.cache.update(log_entries)
+
+        if self.rules:
+            for rule in self.rules.evaluate(log_entries, self):
+                self.log.info('Rule %s (%s) triggered %s', rule.name, rule.text, rule.action)
+                self._metrics.inc('inventum_rule_triggers_total', rule=rule.name)
+
+        if self.store:
+            try:
+                self.store.append(log_entries)
+            except (IOError, OSError) as e:
+                self.log.error('Storing the datalogger record failed: %s', e)
 
         if self.on_data:
             self.on_data(log_entries)
@@ -114,6 +326,9 @@ class Inventum:
 
     def __workflow_goto_io_menu(self):
         self.termser.write(self.MENU_IO)
+        self.last_selected_menu_item = ''
+        self.navigation_row = ''
+        self.__cancel_navigation()
         self._current_state = self.STATE_EXTRA_MENU_SELECTED
 
     def __workflow_goto_datalogger(self):
@@ -121,85 +336,76 @@ class Inventum:
         self._current_state = self.STATE_DATALOGGER
         self.mode = self.MODE_BULK
         self.termser.set_raw_mode()
-        self.datalogger_header = None
-        self.datalogger_buffer = []
+        self.datalogger.reset()
         self.datalogger_start = self.millis()
         self.last_datalogger_entry = self.millis()
+        self.__arm_datalogger_timeout(self.DATALOGGER_TIMEOUT)
         self.log.info('Entering datalogger sequence')
 
     def __workflow_io_select_fan(self):
         selected_row = self.termser.selected_row().strip()
-        if selected_row != '' and selected_row != self.last_selected_menu_item:
+        if selected_row == '':
+            return
+
+        if selected_row != self.navigation_row:
             # /hack for now. Need to figure out this time out sequence
-            self.last_seen = self.millis()
+            self.__arm_progress()
             # /endhack
 
-            selected_menu = int(selected_row[1:3])
-            self.log.debug('IO Status: Active menu item "%d"', selected_menu)
+            # The unit is still working through the last burst, give it time to finish
+            self.navigation_row = selected_row
+            if self.navigation_timer is not None:
+                self.__arm_navigation()
 
-            if selected_menu < self.MENU_IO_FAN:
-                self.termser.key_down()
-            elif selected_menu > self.MENU_IO_FAN:
-                self.termser.key_up()
-            else:
-                self.termser.key_enter()
+        selected_menu = int(selected_row[1:3])
 
+        if selected_menu == self.MENU_IO_FAN:
+            if selected_row != self.last_selected_menu_item:
+                self.log.debug('IO Status: Active menu item "%d"', selected_menu)
+                self.termser.key_enter()
+                self.last_selected_menu_item = selected_row
+
+        elif self.navigation_timer is None:
+            # Plan the keys from the highlighted row to the fan menu item and send them in one burst
+            steps = self.MENU_IO_FAN - selected_menu
+            self.log.debug('IO Status: Active menu item "%d", moving %d rows', selected_menu, steps)
+            if steps > 0:
+                self.termser.key_down(steps)
+            else:
+                self.termser.key_up(-steps)
+            self.__arm_navigation()
             self.last_selected_menu_item = selected_row
 
     def __workflow_io_set_fan_high(self):
         self.log.info("SET value for parameter '3-standen' to: 3")
         self.termser.writeln('3')
+        # Assume the new value until the next datalogger record, so a repeated command is seen as a no-op
+        self.current_status = 3
+        self.__command_done()
         self._current_state = self.STATE_IDLE
-        self.set_target_state(self.STATE_EXTRA_MENU)
+        self.__resume()
 
     def __workflow_io_set_fan_auto(self):
         self.log.info("RESET value for parameter '3-standen'")
         self.termser.key_escape()
+        self.current_status = self.FAN_AUTO
+        self.__command_done()
         self._current_state = self.STATE_IDLE
-        self.set_target_state(self.STATE_EXTRA_MENU)
-
-    def __should_wait(self, wait):
-        return self.millis() - self.datalogger_start <= (wait * 1000)
+        self.__resume()
 
     def __workflow_datalogger_read(self):
-
-        if self.__should_wait(2):
-            return
-
+        # No fixed wait after entering the datalogger: the parser skips everything up to the 'Interval' marker
         if self.termser.has_raw_data():
-            self.datalogger_buffer += self.termser.get_raw_data()
-
-            data = ''.join(self.datalogger_buffer)
-            idx = data.find("Interval")
-            header = 1479
-            if idx != -1:
-                ln = 21
-                data = data[idx + ln:]
-                self.datalogger_buffer = list(data)
-
-            if not self.datalogger_header and len(data) >= header:
-                hdr = map(lambda x: x.strip()
-                                     .replace('(', '')
-                                     .replace(')', '')
-                                     .replace(' ', '_')
-                                     .replace('.', ''), data[0:header].split(','))
-                self.datalogger_header = zip(hdr[0::2], hdr[1::2])
-                # self.log.debug('HEADER[%s]', str(self.datalogger_header))
-                data = data[header+1:]
-                self.datalogger_buffer = list(data)
-
-            idx = data.find('\r\n')
-            if idx != -1:
-                entries = data[:idx].split(',')
-                self.datalogger_buffer = list(data[idx+2:])
-
-                log_entries = dict()
-                for i, h in enumerate(self.datalogger_header):
-                    log_entries[h[1]] = {
-                        "value": entries[(i*2)+1],
-                        "status": entries[(i*2)]
-                    }
+            if self._metrics.enabled:
+                start = Metrics.clock()
+                records = self.datalogger.feed(self.termser.get_raw_data())
+                if records:
+                    self._metrics.inc('inventum_records_total', len(records))
+                    self._metrics.observe('inventum_parse_seconds', (Metrics.clock() - start) / len(records))
+            else:
+                records = self.datalogger.feed(self.termser.get_raw_data())
 
+            for log_entries in records:
                 # self.log.debug('DATA[%s]', str(log_entries))
                 self.__handle_on_data(log_entries)
 
@@ -207,8 +413,9 @@ class Inventum:
         self.termser.set_normal_mode()
         self.termser.key_escape()
         self.mode = self.MODE_TERM
-        self.datalogger_header = []
-        self.datalogger_buffer = []
+        self.datalogger.reset()
+        self.datalogger_timer = self.__cancel(self.datalogger_timer)
+        self.__arm_progress()
         self._current_state = self.STATE_DATALOGGER_EXITED
 
     def __workflow_io_previous_menu(self):
@@ -216,17 +423,42 @@ class Inventum:
         self._current_state = self.STATE_IDLE
 
     def __check_current_status(self):
-        if self._current_state == self.STATE_DATALOGGER:
-            if self.millis() - self.last_datalogger_entry >= (5 * 60 * 1000):
-                self.__workflow_exit_datalogger()
+        # The fan goes back to auto 'reset_after' minutes after the last fan command, once in the datalogger
+        if self._current_state == self.STATE_DATALOGGER and self.fan_reset_due and self.current_status == 3:
+            self.__arm_fan_reset()
+            # Unless a FAN=1 rule still holds, it would not fire again while it does
+            if self.rules and self.rules.active('FAN=1'):
+                self.log.debug('Fan reset postponed, a FAN=1 rule still holds')
+                return
+            self.set_target_state(self.STATE_CMD_FAN_RESET)
 
-            elif self.current_status == 3 and self.millis() - self.last_command >= (self.reset_timeout * 60 * 1000):
-                self.last_command = self.millis()
-                self.set_target_state(self.STATE_CMD_FAN_RESET)
+    def __match_screen(self):
+        if self.termser.generation == self.screen_generation:
+            return False
+        self.screen_generation = self.termser.generation
+        dirty = self.termser.take_dirty_rows()
+
+        line = self.termser.current_row()
+        if self.last_line_debug != line:
+            self.log.debug('LINE: %s', line)
+            self.last_line_debug = line
+
+        for row, text, state, level, message in self.SCREEN_SIGNATURES:
+            if row is None:
+                row = self.termser.row + 1
+            if self._current_state == state or not 0 < row <= len(dirty) or not dirty[row - 1]:
+                continue
+            if self.termser.get_row(row).find(text) != -1:
+                self._current_state = state
+                self.__arm_progress()
+                self.log.log(level, message)
+                return True
+
+        return False
 
     def set_target_state(self, state):
         self.target_state = state
-        self.last_seen = self.millis()
+        self.__arm_progress()
 
     def handle_workflow(self):
 
@@ -244,7 +476,7 @@ class Inventum:
         elif self._current_state == self.STATE_IO_STATUS:
             if self.target_state == self.STATE_CMD_FAN_HIGH or self.target_state == self.STATE_CMD_FAN_RESET:
                 self.__workflow_io_select_fan()
-            elif self.target_state == self.STATE_EXTRA_MENU:
+            elif self.target_state == self.STATE_EXTRA_MENU or self.target_state == self.STATE_DATALOGGER:
                 self.__workflow_io_previous_menu()
         elif self._current_state == self.STATE_IO_CHANGE_FAN:
             if self.target_state == self.STATE_CMD_FAN_HIGH:
@@ -259,47 +491,145 @@ class Inventum:
             elif self.target_state == self.STATE_DATALOGGER:
                 self.__workflow_datalogger_read()
 
-    def start(self):
+    def begin(self):
+        if not self.termser.connected:
+            return
         self.termser.reset()
         self.termser.key_escape()
         self.termser.key_escape()
 
         self.log.info('Starting up TERM interface on Inventum Ecolution. Waiting for login...')
 
-        while self.termser.running():
-
-            time.sleep(0.1)
-
-            if self.mode == self.MODE_TERM:
-                line = self.termser.current_row()
-
-                if self.last_line_debug != line:
-                    self.log.debug('LINE: %s', line)
-                    self.last_line_debug = line
-
-                if line.find('Voer code in') != -1:
-                    self._current_state = self.STATE_LOGIN
-
-                elif line.find('Voer beveiligingscode in') != -1:
-                    self._current_state = self.STATE_CHALLENGE
-
-                elif self.termser.get_row(2).find(" EXTRAMENU") != -1 and self._current_state != self.STATE_EXTRA_MENU:
-                    self._current_state = self.STATE_EXTRA_MENU
-                    self.last_seen = self.millis()
-                    self.log.info('Login successful')
-
-                elif self.termser.get_row(1).find("IO status") != -1 and self._current_state != self.STATE_IO_STATUS:
-                    self._current_state = self.STATE_IO_STATUS
-                    self.log.debug('Activated IO Status menu')
-
-                elif self.termser.get_row(51).find('   3-standen :') != -1:
-                    self._current_state = self.STATE_IO_CHANGE_FAN
-                    self.log.debug('Selected "3-standen" menu item for change')
-
-                # wait 5 seconds, and reset to main menu
-                elif self._current_state >= self.STATE_EXTRA_MENU and self.millis() - self.last_seen > 5000:
-                    self.__reset__()
+    def start(self):
+        # Data from the reader thread ends the wait as well
+        self.termser.on_receive = self.wakeup
+        self.begin()
 
-            self.handle_workflow()
+        while self.run_once():
+            self.wait()
 
+        self.finish_profiles()
         self.termser.close()
+        pipe, self.wakeup_pipe = self.wakeup_pipe, None
+        if pipe is not None:
+            for fd in pipe:
+                os.close(fd)
+
+    def timeout(self):
+        """
+        Seconds the loop may sleep when no data arrives: until the next timer, at most MAX_WAIT.
+        """
+        return self.timers.timeout(self.MAX_WAIT)
+
+    def wait(self):
+        """
+        Sleep until data arrives on the serial port, wakeup() is called or the next timer is due. Ports without a
+        file descriptor or reader thread to wait on are polled every POLL_INTERVAL seconds.
+        """
+        timeout = self.timeout()
+        termser = self.termser
+        fd = termser.fileno() if termser.connected else None
+        if fd is not None:
+            select.select([fd, self.wakeup_pipe[0]], [], [], timeout)
+        elif termser.connected and termser.reader is None:
+            time.sleep(min(timeout, self.POLL_INTERVAL))
+        else:
+            self.wakeup_event.wait(timeout)
+        self.__drain_wakeups()
+
+    def __drain_wakeups(self):
+        # Empty the pipe before clearing the event, a wakeup() in between leaves its byte for the next wait()
+        try:
+            while os.read(self.wakeup_pipe[0], 512):
+                pass
+        except OSError:
+            pass
+        self.wakeup_event.clear()
+
+    def wakeup(self):
+        """
+        Have wait() return, e.g. after a command was queued from another thread. Both the event and the pipe are
+        signalled, as wait() may be about to block on either of them.
+        """
+        self.wakeup_event.set()
+        pipe = self.wakeup_pipe
+        if pipe is not None:
+            try:
+                os.write(pipe[1], b'x')
+            except OSError:
+                pass
+
+    def start_profile(self, kind, seconds):
+        """
+        Profile (PROFILE) or trace the allocations (MEMTRACE) of this thread for 'seconds'. The summary goes to
+        on_profile when the window is over. False when a session of that kind is running already.
+        """
+        session = Profiling.create(kind, seconds, self.profile_prefix)
+        if any(other.kind == session.kind for other in self.profiles):
+            return False
+        session.start()
+        self.profiles.append(session)
+        self.timers.call_later(seconds, self.finish_profiles, [session])
+        self.log.info('Started %s for %d seconds, writing to %s', session.kind, seconds, session.path)
+        return True
+
+    def finish_profiles(self, sessions=None):
+        """
+        Finish the given profile sessions, all running ones by default.
+        """
+        for session in [s for s in sessions or list(self.profiles) if s in self.profiles]:
+            self.profiles.remove(session)
+            try:
+                summary = session.finish()
+            except (IOError, OSError, RuntimeError) as e:
+                # RuntimeError: tracemalloc was stopped by someone else during a MEMTRACE
+                self.log.error('Could not write %s: %s', session.path, e)
+                summary = {'kind': session.kind, 'file': session.path, 'error': str(e)}
+            else:
+                self.log.info('Finished %s, written to %s', session.kind, session.path)
+            if self.on_profile:
+                self.on_profile(summary)
+
+    def run_once(self):
+        """
+        Read the serial port and step the workflow once, or try to reopen the port while it is gone. The MQTT
+        session, caches and queued commands stay as they are while the port is down. False after interrupt().
+        """
+        try:
+            if not self.termser.connected:
+                # Only the timers, among them the next attempt to reopen the port, which queues the first keys,
+                # and the commands that do not need the unit, so QUIT still stops the loop
+                if self.commands:
+                    self.commands.poll_offline(self)
+                self.timers.run_due()
+                if self.termser.connected:
+                    self.termser.flush()
+            elif self.termser.running():
+                self.step()
+        except Serial.PortError as e:
+            # Only the port I/O of termser raises PortError, errors of the store, rules or on_data are not a lost
+            # port
+            self.__connection_lost(e)
+        return self.termser.keep_running
+
+    def step(self):
+        if self._metrics.enabled:
+            now = Metrics.clock()
+            self._metrics.inc('inventum_state_seconds_total', now - self.state_since,
+                              state=STATE_NAMES.get(self._current_state))
+            self.state_since = now
+
+        if self.commands:
+            self.commands.poll(self)
+
+        if self.mode == self.MODE_TERM:
+            self.__match_screen()
+
+        # Timeouts after the screen was matched, so a screen that just arrived counts as progress
+        self.timers.run_due()
+
+        self.handle_workflow()
+        self.termser.flush()
+
+
+STATE_NAMES = dict((value, name[6:].lower()) for name, value in vars(Inventum).items() if name.startswith('STATE_'))
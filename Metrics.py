@@ -0,0 +1,300 @@
+from __future__ import print_function
+
+import bisect
+import json
+import logging
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+clock = getattr(time, 'perf_counter', time.time)
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels))
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms of the daemon, rendered in the Prometheus text format or as a JSON snapshot.
+
+    Series are identified by name and labels. Values that already exist elsewhere (TermSerial.stats(), parser
+    counters) are not copied on every update but read by collectors when the metrics are rendered.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        self.buckets = {}
+        self.values = {}
+        self.collectors = []
+
+    def describe(self, name, kind, text, buckets=DEFAULT_BUCKETS):
+        self.kinds[name] = kind
+        self.help[name] = text
+        if kind == 'histogram':
+            self.buckets[name] = tuple(buckets)
+
+    def child(self, **labels):
+        return LabelledMetrics(self, labels)
+
+    def add_collector(self, collector):
+        """
+        'collector' is called with the metrics before they are rendered, to set gauges and counters it keeps itself.
+        """
+        self.collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(self.buckets.get(name, DEFAULT_BUCKETS))
+            histogram.observe(value)
+
+    def __collect(self):
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                logging.debug('Metrics collector failed: %s', e)
+        with self.lock:
+            return sorted(self.values.items(), key=lambda item: (item[0][0], item[0][1]))
+
+    def render(self):
+        """
+        All series in the Prometheus text exposition format.
+        """
+        lines = []
+        described = set()
+        for (name, labels), value in self.__collect():
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append('# HELP %s %s' % (name, self.help[name]))
+                lines.append('# TYPE %s %s' % (name, self.kinds.get(name, 'untyped')))
+
+            if isinstance(value, Histogram):
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append('%s %d' % (_series(name + '_bucket', labels + (('le', repr(float(bound))),)),
+                                            cumulative))
+                lines.append('%s %d' % (_series(name + '_bucket', labels + (('le', '+Inf'),)), value.count))
+                lines.append('%s %r' % (_series(name + '_sum', labels), value.sum))
+                lines.append('%s %d' % (_series(name + '_count', labels), value.count))
+            else:
+                lines.append('%s %r' % (_series(name, labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        All series as a dict for JSON, histograms as count, sum and mean.
+        """
+        result = {}
+        for (name, labels), value in self.__collect():
+            if isinstance(value, Histogram):
+                value = {'count': value.count, 'sum': value.sum,
+                         'mean': value.sum / value.count if value.count else 0.0}
+            result[_series(name, labels)] = value
+        return result
+
+
+class LabelledMetrics(object):
+    """
+    A view on Metrics that adds fixed labels, e.g. the unit, to every update.
+    """
+
+    enabled = True
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+
+    def child(self, **labels):
+        merged = dict(self.labels)
+        merged.update(labels)
+        return LabelledMetrics(self.metrics, merged)
+
+    def add_collector(self, collector):
+        self.metrics.add_collector(lambda metrics: collector(self))
+
+    def inc(self, name, value=1, **labels):
+        labels.update(self.labels)
+        self.metrics.inc(name, value, **labels)
+
+    def set(self, name, value, **labels):
+        labels.update(self.labels)
+        self.metrics.set(name, value, **labels)
+
+    def observe(self, name, value, **labels):
+        labels.update(self.labels)
+        self.metrics.observe(name, value, **labels)
+
+
+class NullMetrics(object):
+    """
+    Stand-in when metrics are disabled, every update is a no-op. Hot paths check 'enabled' before timing anything.
+    """
+
+    enabled = False
+
+    def describe(self, name, kind, text, buckets=DEFAULT_BUCKETS):
+        pass
+
+    def child(self, **labels):
+        return self
+
+    def add_collector(self, collector):
+        pass
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+
+NULL = NullMetrics()
+
+
+def describe_all(metrics):
+    metrics.describe('inventum_serial_bytes_total', 'counter', 'Bytes read from the serial port')
+    metrics.describe('inventum_serial_writes_total', 'counter', 'Writes to the serial port')
+    metrics.describe('inventum_serial_echo_timeouts_total', 'counter', 'Written bytes never echoed by the unit')
+    metrics.describe('inventum_serial_buffer_bytes', 'gauge', 'Bytes waiting in the reader ring buffer')
+    metrics.describe('inventum_serial_dropped_bytes_total', 'counter', 'Bytes dropped on a full ring buffer')
+    metrics.describe('inventum_serial_disconnects_total', 'counter', 'Times the serial port was lost')
+    metrics.describe('inventum_records_total', 'counter', 'Datalogger records parsed')
+    metrics.describe('inventum_records_malformed_total', 'counter', 'Datalogger lines that could not be parsed')
+    metrics.describe('inventum_parse_seconds', 'histogram', 'Parse time per datalogger record',
+                     (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01))
+    metrics.describe('inventum_state_seconds_total', 'counter', 'Time spent in each workflow state')
+    metrics.describe('inventum_resets_total', 'counter', 'Returns to the login after 5 seconds without progress')
+    metrics.describe('inventum_datalogger_timeouts_total', 'counter',
+                     'Datalogger exits after 5 minutes without a record')
+    metrics.describe('inventum_first_record_seconds', 'histogram',
+                     'From selecting the datalogger to its first record')
+    metrics.describe('inventum_rule_triggers_total', 'counter', 'Actions triggered by the local rules')
+    metrics.describe('inventum_command_seconds', 'histogram', 'From a fan command to setting it on the unit')
+    metrics.describe('inventum_publish_seconds', 'histogram', 'Time to hand a record to the MQTT client')
+    metrics.describe('inventum_mqtt_backlog', 'gauge', 'Messages queued in the MQTT client')
+
+
+class MetricsServer(object):
+    """
+    Serves the metrics in the Prometheus text format on http://<address>:<port>/metrics from a daemon thread.
+    """
+
+    def __init__(self, metrics, port, address='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logging.debug('Metrics request: ' + fmt, *args)
+
+        self.server = HTTPServer((address, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StatsPublisher(object):
+    """
+    Publishes a JSON snapshot of the metrics on <topic>/stats every 'interval' seconds, from a daemon thread or,
+    when started with the asyncio event loop that drives the MQTT client, from a timer on that loop: the client
+    is not thread safe then.
+    """
+
+    def __init__(self, metrics, client, topic, interval):
+        self.metrics = metrics
+        self.client = client
+        self.topic = topic + '/stats'
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.loop = None
+        self.handle = None
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            self.publish()
+
+    def __tick(self):
+        self.publish()
+        self.handle = self.loop.call_later(self.interval, self.__tick)
+
+    def publish(self):
+        self.client.publish(self.topic, json.dumps(self.metrics.snapshot(), sort_keys=True))
+
+    def start(self, loop=None):
+        if loop is not None:
+            self.loop = loop
+            self.handle = loop.call_later(self.interval, self.__tick)
+            return
+        self.thread = threading.Thread(target=self.__run, name='metrics-stats')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # From the loop when started with one
+        self.stopped.set()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
@@ -0,0 +1,127 @@
+from __future__ import print_function
+
+import cProfile
+import pstats
+import threading
+import time
+
+import Scheduler
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class ProfileSession(object):
+    """
+    A window of cProfile on the thread that started it. The stats are written to <path>.prof, for pstats or
+    snakeviz, the summary has the functions with the most time of their own.
+    """
+
+    kind = 'profile'
+    suffix = '.prof'
+    TOP = 10
+
+    def __init__(self, seconds, path):
+        self.seconds = seconds
+        self.path = path + self.suffix
+        self.started = None
+
+    def start(self):
+        self.started = Scheduler.monotonic()
+        self.begin()
+
+    def finish(self):
+        """
+        Stop, write the results and return the summary for <topic>/profile.
+        """
+        top = self.end()
+        return {'kind': self.kind, 'seconds': round(Scheduler.monotonic() - self.started, 3), 'file': self.path,
+                'top': top}
+
+    def begin(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def end(self):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
+        stats = pstats.Stats(self.profiler).stats
+        top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:self.TOP]
+        return [{'function': '%s:%d(%s)' % function, 'calls': calls, 'seconds': round(own, 6),
+                 'cumulative': round(cumulative, 6)}
+                for function, (_, calls, own, cumulative, _) in top]
+
+
+class MemoryTraceSession(ProfileSession):
+    """
+    A window of tracemalloc (Python 3.4+). The snapshot at the end is written to <path>.snapshot, the summary has
+    the source lines whose allocations grew the most during the window.
+
+    Tracing is process wide while the sessions of several units may overlap, it is stopped when the last running
+    session ends and only when the sessions started it.
+    """
+
+    kind = 'memtrace'
+    suffix = '.snapshot'
+    lock = threading.Lock()
+    running = 0
+    owns_tracing = False
+
+    def __init__(self, seconds, path):
+        if tracemalloc is None:
+            raise ValueError('MEMTRACE needs tracemalloc, Python 3.4 or later')
+        super(MemoryTraceSession, self).__init__(seconds, path)
+
+    @staticmethod
+    def snapshot():
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+    def begin(self):
+        cls = MemoryTraceSession
+        with cls.lock:
+            if cls.running == 0:
+                # Someone else may be tracing already, leave that running
+                cls.owns_tracing = not tracemalloc.is_tracing()
+                if cls.owns_tracing:
+                    tracemalloc.start()
+            cls.running += 1
+        self.before = self.snapshot()
+
+    def end(self):
+        cls = MemoryTraceSession
+        try:
+            after = self.snapshot()
+        finally:
+            with cls.lock:
+                cls.running -= 1
+                if cls.running == 0 and cls.owns_tracing:
+                    tracemalloc.stop()
+                    cls.owns_tracing = False
+        after.dump(self.path)
+        top = after.compare_to(self.before, 'lineno')[:self.TOP]
+        self.before = None
+        return [{'location': '%s:%d' % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                 'size': stat.size, 'size_diff': stat.size_diff, 'count': stat.count, 'count_diff': stat.count_diff}
+                for stat in top]
+
+
+SESSIONS = {
+    'PROFILE': ProfileSession,
+    'MEMTRACE': MemoryTraceSession,
+}
+
+MAX_SECONDS = 3600
+
+
+def create(kind, seconds, prefix):
+    """
+    Session of 'kind' (PROFILE or MEMTRACE) writing to '<prefix>-<kind>-<time>.<ext>'.
+    """
+    if kind not in SESSIONS:
+        raise ValueError('Invalid profile kind: %s' % kind)
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ValueError('Profile window must be 1 to %d seconds' % MAX_SECONDS)
+    cls = SESSIONS[kind]
+    return cls(seconds, '%s-%s-%s' % (prefix, cls.kind, time.strftime('%Y%m%d-%H%M%S')))
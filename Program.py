@@ -1,18 +1,141 @@
 #!/usr/bin/python -tt
 from daemonpy.daemon import Daemon
 
+import Commands
+import Encoding
 import Inventum as Inventum
+import Metrics
+import Publisher
+import Rules
+import Store
+import argparse
+import json
 import logging
 import configparser
+import os
 import sys
-import json
+import threading
+import time
 import paho.mqtt.client as mqtt
 
 
+class UnitLogger(logging.LoggerAdapter):
+    """
+    Prefixes the log lines of a unit with its name when the daemon drives more than one unit.
+    """
+
+    def process(self, msg, kwargs):
+        return '[%s] %s' % (self.extra['unit'], msg), kwargs
+
+
+class InventumUnit(object):
+    """
+    One Inventum unit: its serial device, its MQTT topic prefix and where its records go.
+    """
+    # Most rows a query on <topic>/query gets, a larger limit is lowered to this
+    MAX_QUERY_LIMIT = 1000
+
+    def __init__(self, name, client, topic):
+        self.name = name
+        self.client = client
+        self.topic = topic
+        self.inventum = None
+        self.publisher = None
+        self.aggregator = None
+        self.store = None
+        self.metrics = Metrics.NULL
+        self.commands = Commands.CommandQueue(self.on_ack)
+        self.retained = False
+
+    def on_command(self, payload):
+        logging.info('Received command for %s: %s', self.name, payload)
+        self.commands.put(payload)
+
+    def on_ack(self, ack):
+        self.client.publish(self.topic + '/ack', json.dumps(ack))
+
+    def on_get(self, payload):
+        # Answered from the last-value cache, the unit is not asked
+        try:
+            request = json.loads(payload) if payload.startswith('{') else {'fields': payload.split(',')}
+            fields = [name.strip() for name in request.get('fields') or [] if name.strip()]
+            response = {'id': request.get('id'), 'updated': self.inventum.cache.updated,
+                        'data': self.inventum.cache.get(fields)}
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.error('Invalid get request %s: %s', payload, e)
+            response = {'error': str(e)}
+        self.client.publish(self.topic + '/get/result', json.dumps(response))
+
+    def on_change(self, names):
+        if not self.retained:
+            return
+        for name in names:
+            self.client.publish(self.topic + '/state/' + name, json.dumps(self.inventum.cache.entry(name)),
+                                qos=1, retain=True)
+
+    def on_profile(self, summary):
+        self.client.publish(self.topic + '/profile', json.dumps(summary))
+
+    def on_availability(self, online):
+        # Retained, so a subscriber that connects later sees whether the serial port of the unit is up. The last
+        # will only covers <mqtt topic>/availability, a unit on a topic of its own is only online when both are
+        return self.client.publish(self.topic + '/availability', 'online' if online else 'offline', qos=1, retain=True)
+
+    def on_query(self, payload):
+        request = {}
+        try:
+            request = json.loads(payload) if payload else {}
+            limit = request.get('limit', self.MAX_QUERY_LIMIT)
+            if isinstance(limit, bool) or not isinstance(limit, int) or limit < 0:
+                raise ValueError('Invalid limit: %s' % json.dumps(limit))
+            rows = self.store.query(request.get('start'), request.get('end'), request.get('fields'),
+                                    min(limit, self.MAX_QUERY_LIMIT))
+            response = {'id': request.get('id'), 'rows': rows}
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.error('Invalid query %s: %s', payload, e)
+            response = {'id': request.get('id') if isinstance(request, dict) else None, 'error': str(e)}
+        self.client.publish(self.topic + '/query/result', json.dumps(response))
+
+    def on_data(self, data):
+        if self.publisher:
+            if self.metrics.enabled:
+                start = Metrics.clock()
+                self.publisher.publish(data)
+                self.metrics.observe('inventum_publish_seconds', Metrics.clock() - start)
+            else:
+                self.publisher.publish(data)
+        if self.aggregator:
+            self.aggregator.publish(data)
+
+    def run(self):
+        # Worker thread of the unit, a failing port only stops this unit
+        try:
+            self.inventum.start()
+        except Exception as e:
+            logging.exception('Unit %s stopped: %s', self.name, e)
+
+    def close(self):
+        if self.publisher:
+            self.publisher.flush()
+        if self.aggregator:
+            self.aggregator.flush()
+        if self.store:
+            self.store.close()
+        return self.on_availability(False)
+
+
 class InventumProcessor(object):
+    UNIT_PREFIX = 'unit:'
+    DRAIN_TIMEOUT = 5.0  # seconds the last messages get to reach the broker at shutdown
+
     def __init__(self):
         self.client = None
-        self.inventum = None
+        self.units = []
+        self.routes = {}
+        self.runner = None
+        self.metrics = Metrics.NULL
+        self.metrics_server = None
+        self.stats_publisher = None
         self.mqtttopic = ''
 
     def logging_setup(self, level, log_file, foreground):
@@ -26,31 +149,208 @@ class InventumProcessor(object):
                                 filename=log_file, level=level)
 
     def on_message(self, client, userdata, message):
-        payload = str(message.payload.decode("utf-8"))
-        logging.info('Received command: %s', payload)
-
-        if payload == 'FAN=1':
-            self.inventum.set_command_fan_high()
-        elif payload == 'FAN=0':
-            self.inventum.set_command_fan_auto()
-        elif payload == 'DATA=1':
-            self.inventum.set_command_data_start()
-        elif payload == 'DATA=0':
-            self.inventum.set_command_data_stop()
-        elif payload == 'QUIT':
-            self.inventum.interrupt()
+        route = self.routes.get(message.topic)
+        if route is None:
+            logging.error('Message on unknown channel %s', message.topic)
+            return
+
+        route(str(message.payload.decode("utf-8")))
+
+        if self.runner:
+            self.runner.wakeup()
         else:
-            logging.error('Unknown command received: %s', payload)
+            for unit in self.units:
+                unit.inventum.wakeup()
 
-    def on_data(self, data):
-        json_data = json.dumps(data)
-        combinedtopic = self.mqtttopic + '/data'
-        logging.debug('Publishing data to MQTT on channel %s', combinedtopic)
-        self.client.publish(combinedtopic, json_data)
+    def on_connect(self, client, userdata, flags, rc):
+        # Also after every reconnect: the session is clean, the broker forgot the subscriptions
+        if rc != 0:
+            logging.error('MQTT connection refused: %s', mqtt.connack_string(rc))
+            return
+        logging.info('Connected to MQTT, subscribing to %d channels', len(self.routes))
+        for topic in list(self.routes):
+            client.subscribe(topic)
+        # The broker published the last will when the connection dropped
+        if self.units:
+            for unit in self.units:
+                unit.on_availability(unit.inventum.termser.connected)
+            self.publish_availability(True)
 
-    def run_process(self, foreground):
+    def subscribe(self, topic, handler):
+        # on_connect() subscribes, here only when the connection is up already
+        self.routes[topic] = handler
+        if self.client.is_connected():
+            self.client.subscribe(topic)
+
+    def create_publisher(self, config, topic, scheduler=None):
+        mode = config.get("mqtt", "publish", fallback="full")
+        qos = config.getint("mqtt", "qos", fallback=0)
+
+        if mode == "none":
+            return None
+        elif mode == "full":
+            encoding = config.get("mqtt", "encoding", fallback="json")
+            return Publisher.FullPublisher(self.client, topic, qos, Encoding.create(encoding))
+        elif mode == "changes":
+            deadbands = dict((name, float(value)) for name, value in config.items("deadband")) \
+                if config.has_section("deadband") else {}
+            default_deadband = deadbands.pop("default", 0)
+            heartbeat = config.getint("mqtt", "heartbeat", fallback=300)
+            return Publisher.ChangePublisher(self.client, topic, deadbands, default_deadband, heartbeat, qos)
+        elif mode == "batch":
+            size = config.getint("mqtt", "batch_size", fallback=10)
+            window = config.getfloat("mqtt", "batch_window", fallback=0)
+            fmt = config.get("mqtt", "batch_format", fallback="json")
+            return Publisher.BatchPublisher(self.client, topic, size, window, fmt, qos, scheduler)
+
+        raise ValueError('Invalid publish mode: %s' % mode)
+
+    def create_aggregator(self, config, topic, scheduler=None):
+        windows = config.get("aggregate", "windows", fallback="")
+        if windows == "":
+            return None
+        fields = config.get("aggregate", "fields", fallback="")
+        qos = config.getint("mqtt", "qos", fallback=0)
+        return Publisher.AggregatePublisher(self.client, topic, [int(w) for w in windows.split(',')],
+                                            [f.strip() for f in fields.split(',') if f.strip()], qos, scheduler)
+
+    @staticmethod
+    def read_config():
         config = configparser.RawConfigParser()
         config.read('/etc/inventumusb.conf')
+        return config
+
+    @classmethod
+    def unit_sections(cls, config):
+        """
+        The [unit:<name>] sections as (name, section), or the single unit of [inventum] as (None, 'inventum').
+        """
+        units = [(section[len(cls.UNIT_PREFIX):], section) for section in config.sections()
+                 if section.startswith(cls.UNIT_PREFIX)]
+        return units or [(None, 'inventum')]
+
+    @staticmethod
+    def create_rules(config):
+        if not config.has_section("rules"):
+            return None
+        return Rules.create(config.items("rules")) or None
+
+    @staticmethod
+    def create_store(config, unit=None):
+        directory = config.get("store", "directory", fallback="")
+        if directory == "":
+            return None
+        if unit is not None:
+            directory = os.path.join(directory, unit)
+        segment_size = config.getint("store", "segment_size", fallback=1 << 20)
+        max_size = config.getint("store", "max_size", fallback=64 << 20)
+        return Store.TimeSeriesStore(directory, segment_size, max_size)
+
+    def create_metrics(self, config):
+        port = config.getint("metrics", "port", fallback=0)
+        interval = config.getfloat("metrics", "interval", fallback=0)
+        if not port and not interval:
+            return
+
+        self.metrics = Metrics.Metrics()
+        Metrics.describe_all(self.metrics)
+        self.metrics.add_collector(self.__collect_metrics)
+        if port:
+            address = config.get("metrics", "address", fallback="127.0.0.1")
+            self.metrics_server = Metrics.MetricsServer(self.metrics, port, address)
+            self.metrics_server.start()
+            logging.info('Serving metrics on http://%s:%d/metrics', address, port)
+        if interval:
+            self.stats_publisher = Metrics.StatsPublisher(self.metrics, self.client, self.mqtttopic, interval)
+            self.stats_publisher.start(self.runner.loop if self.runner else None)
+            logging.info('Publishing metrics every %ds on MQTT channel %s/stats', interval, self.mqtttopic)
+
+    def __collect_metrics(self, metrics):
+        # Messages paho has not finished sending yet, it has no public accessor for them
+        metrics.set('inventum_mqtt_backlog', len(getattr(self.client, '_out_messages', ())))
+
+    def create_unit(self, config, name, section):
+        topic = config.get(section, "topic", fallback=self.mqtttopic if name is None else self.mqtttopic + '/' + name)
+        device = config.get(section, "device", fallback=config.get("inventum", "device", fallback="/dev/ttyACM0"))
+        reset_after = config.getint(section, "reset", fallback=config.getint("inventum", "reset", fallback=20))
+        reader_buffer = config.getint(section, "reader_buffer",
+                                      fallback=config.getint("inventum", "reader_buffer", fallback=0))
+
+        unit = InventumUnit(name or 'inventum', self.client, topic)
+        logger = logging if name is None else UnitLogger(logging.getLogger(), {'unit': name})
+        unit.inventum = Inventum.Inventum(logger, device, reset_after, reader_buffer)
+        trace = config.get(section, "trace", fallback="")
+        if trace:
+            logging.info('Recording the serial traffic of %s in %s', unit.name, trace)
+            unit.inventum.termser.start_trace(trace)
+        unit.inventum.on_data = unit.on_data
+        unit.inventum.commands = unit.commands
+        unit.inventum.on_availability = unit.on_availability
+        unit.inventum.cache.on_change = unit.on_change
+        unit.inventum.on_profile = unit.on_profile
+        # PROFILE= and MEMTRACE= results are written next to the logfile
+        logfile = config.get("inventum", "logfile", fallback="/var/log/inventum.log")
+        unit.inventum.profile_prefix = os.path.join(os.path.dirname(os.path.abspath(logfile)), 'inventum-' + unit.name)
+        unit.retained = config.getboolean("mqtt", "retained", fallback=False)
+        unit.on_availability(unit.inventum.termser.connected)
+        unit.publisher = self.create_publisher(config, topic, unit.inventum.timers)
+        unit.aggregator = self.create_aggregator(config, topic, unit.inventum.timers)
+        unit.store = unit.inventum.store = self.create_store(config, name)
+        unit.inventum.rules = self.create_rules(config)
+        if self.metrics.enabled:
+            unit.metrics = unit.inventum.metrics = self.metrics.child(unit=unit.name)
+
+        logging.info('Unit %s on %s, waiting for commands on MQTT channel %s/commands', unit.name, device, topic)
+        self.subscribe(topic + '/commands', unit.on_command)
+        self.subscribe(topic + '/get', unit.on_get)
+        if unit.store:
+            logging.info('Storing records in %s, queries on MQTT channel %s/query', unit.store.directory, topic)
+            self.subscribe(topic + '/query', unit.on_query)
+        return unit
+
+    def run_query(self, args):
+        parser = argparse.ArgumentParser(prog='%s query' % sys.argv[0],
+                                         description='Print stored datalogger records as JSON, one per line')
+        parser.add_argument('--unit', help='unit to query when the configuration has [unit:<name>] sections')
+        parser.add_argument('--start', type=float, help='first timestamp (seconds since the epoch)')
+        parser.add_argument('--end', type=float, help='timestamp to stop before (seconds since the epoch)')
+        parser.add_argument('--last', type=float, help='only the records of the last LAST seconds')
+        parser.add_argument('--fields', help='comma separated fields to print, all by default')
+        parser.add_argument('--limit', type=int, help='maximum number of records')
+        options = parser.parse_args(args)
+
+        store = self.create_store(self.read_config(), options.unit)
+        if store is None:
+            print("No [store] directory configured")
+            return 2
+
+        start = time.time() - options.last if options.last else options.start
+        fields = options.fields.split(',') if options.fields else None
+        for row in store.query(start, options.end, fields, options.limit):
+            print(json.dumps(row, sort_keys=True))
+        return 0
+
+    def publish_availability(self, online):
+        # The daemon itself on <topic>/availability, which the last will sets to offline when the process dies. A
+        # single unit on that topic publishes the state of its port there itself.
+        if all(unit.topic != self.mqtttopic for unit in self.units):
+            return self.client.publish(self.mqtttopic + '/availability', 'online' if online else 'offline', qos=1,
+                                       retain=True)
+        return None
+
+    def stop(self):
+        """
+        Publish the last state of the units and the daemon, returns the MQTTMessageInfo of the last message.
+        """
+        if self.stats_publisher:
+            self.stats_publisher.stop()
+        info = None
+        for unit in self.units:
+            info = unit.close()
+        return self.publish_availability(False) or info
+
+    def run_process(self, foreground):
+        config = self.read_config()
 
         mqttserver = config.get("mqtt", "server", fallback="localhost")
         mqttport = config.getint("mqtt", "port", fallback=1883)
@@ -61,8 +361,7 @@ class InventumProcessor(object):
 
         loglevel = config.get("inventum", "loglevel", fallback="INFO")
         logfile = config.get("inventum", "logfile", fallback="/var/log/inventum.log")
-        device = config.get("inventum", "device", fallback="/dev/ttyACM0")
-        reset_after = config.getint("inventum", "reset", fallback=20)
+        engine = config.get("inventum", "engine", fallback="thread")
 
         numeric_level = getattr(logging, loglevel.upper(), None)
         if not isinstance(numeric_level, int):
@@ -75,21 +374,47 @@ class InventumProcessor(object):
             if mqttusername != "":
                 self.client.username_pw_set(mqttusername, mqttpasswd);
                 logging.debug("Set username -%s-, password -%s-", mqttusername, mqttpasswd)
+            self.client.will_set(self.mqtttopic + '/availability', 'offline', qos=1, retain=True)
+            self.client.on_connect = self.on_connect
+            if engine == "asyncio":
+                import AsyncRunner
+                self.runner = AsyncRunner.AsyncRunner(self.client)
             self.client.connect(mqttserver, port=mqttport)
             logging.info('Connected to MQTT %s:%s', mqttserver, mqttport)
             self.client.on_message = self.on_message
-            logging.info('Waiting for commands on MQTT channel %s/commands', self.mqtttopic)
-            self.client.subscribe(self.mqtttopic + '/commands')
-            self.client.loop_start()
         except Exception as e:
             logging.error("%s:%s: %s", mqttserver, mqttport, e)
             return 3
 
-        self.inventum = Inventum.Inventum(logging, device, reset_after)
-        self.inventum.on_data = self.on_data
-        self.inventum.start()
+        self.create_metrics(config)
+        self.units = [self.create_unit(config, name, section) for name, section in self.unit_sections(config)]
+        self.publish_availability(True)
+        if self.runner is None:
+            self.client.loop_start()
 
-        self.client.loop_stop()
+        if self.runner:
+            self.runner.run([unit.inventum for unit in self.units], self.stop)
+        else:
+            # One worker thread per unit, so a stalled serial port does not hold up the other units
+            workers = [threading.Thread(target=unit.run, name='unit-%s' % unit.name) for unit in self.units]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(1)
+
+            info = self.stop()
+            if info is not None:
+                try:
+                    info.wait_for_publish(self.DRAIN_TIMEOUT)
+                except (RuntimeError, ValueError) as e:
+                    logging.warning('Last MQTT messages not sent: %s', e)
+            self.client.disconnect()
+            self.client.loop_stop()
+
+        if self.metrics_server:
+            self.metrics_server.stop()
         return 0
 
 
@@ -100,8 +425,11 @@ class MyDaemon(Daemon):
 
 
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and 'query' == sys.argv[1]:
+        sys.exit(InventumProcessor().run_query(sys.argv[2:]))
+
     if len(sys.argv) != 2:
-        print("usage: %s start|stop|restart|foreground" % sys.argv[0])
+        print("usage: %s start|stop|restart|foreground|query" % sys.argv[0])
         sys.exit(2)
 
     if 'foreground' == sys.argv[1]:
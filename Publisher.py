@@ -0,0 +1,266 @@
+from __future__ import print_function
+
+import json
+import logging
+import struct
+import time
+import zlib
+
+import Encoding
+import Scheduler
+
+
+class FullPublisher(object):
+    """
+    Publishes every datalogger record as one message on <topic>/data, encoded by an Encoding encoder (the nested
+    JSON by default). Encoders with a fixed layout publish it, retained, on <topic>/schema.
+    """
+
+    def __init__(self, client, topic, qos=0, encoder=None):
+        self.client = client
+        self.topic = topic + '/data'
+        self.schema_topic = topic + '/schema'
+        self.qos = qos
+        self.encoder = encoder or Encoding.JsonEncoder()
+
+    def publish(self, record):
+        schema = self.encoder.schema(record)
+        if schema is not None:
+            logging.info('Publishing payload schema to MQTT on channel %s', self.schema_topic)
+            self.client.publish(self.schema_topic, schema, qos=1, retain=True)
+
+        logging.debug('Publishing data to MQTT on channel %s', self.topic)
+        self.client.publish(self.topic, self.encoder.encode(record), qos=self.qos)
+
+    def flush(self):
+        pass
+
+
+class ChangePublisher(object):
+    """
+    Publishes only the fields that changed since they were last published, each on <topic>/data/<field>.
+
+    Numeric fields have to move more than their deadband before they count as changed, deadbands are matched on
+    the field name case insensitive. A field that has not been published for 'heartbeat' seconds (on the monotonic
+    'clock') is sent again regardless, 0 disables the heartbeat.
+    """
+
+    def __init__(self, client, topic, deadbands=None, default_deadband=0, heartbeat=0, qos=0,
+                 clock=Scheduler.monotonic):
+        self.client = client
+        self.topic = topic + '/data/'
+        self.qos = qos
+        self.deadbands = dict((name.lower(), value) for name, value in (deadbands or {}).items())
+        self.default_deadband = default_deadband
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.last = {}
+
+    def reset(self):
+        self.last = {}
+
+    def flush(self):
+        pass
+
+    def __changed(self, name, previous, value):
+        if isinstance(value, (int, float)) and isinstance(previous, (int, float)):
+            return abs(value - previous) > self.deadbands.get(name.lower(), self.default_deadband)
+        return value != previous
+
+    def publish(self, record):
+        now = self.clock()
+        published = 0
+        for name, value in record.items():
+            last = self.last.get(name)
+            if last is not None and not self.__changed(name, last[0], value):
+                if not self.heartbeat or now - last[1] < self.heartbeat:
+                    continue
+
+            self.client.publish(self.topic + name, str(value), qos=self.qos)
+            self.last[name] = (value, now)
+            published += 1
+
+        logging.debug('Published %d of %d fields to MQTT on channel %s<field>', published, len(record), self.topic)
+
+
+class BatchPublisher(object):
+    """
+    Gathers records and publishes them together as one message on <topic>/batch.
+
+    A batch is flushed when it holds 'size' records or when its oldest record is 'window' seconds old. With a
+    'scheduler' (the Scheduler of the unit, so the flush runs on its workflow thread) the window is a timer started
+    by the first record of a batch, without one it is only checked on the monotonic clock when a record arrives. Each
+    entry is {"time": <epoch>, "data": <record>}, formats:
+        json:   JSON array of the entries
+        binary: every entry as JSON prefixed with its length as 4 byte big endian integer
+        zlib:   zlib compressed JSON array
+    """
+
+    FORMATS = ('json', 'binary', 'zlib')
+
+    def __init__(self, client, topic, size=10, window=0, fmt='json', qos=0, scheduler=None):
+        if fmt not in self.FORMATS:
+            raise ValueError('Invalid batch format: %s' % fmt)
+
+        self.client = client
+        self.topic = topic + '/batch'
+        self.size = size
+        self.window = window
+        self.format = fmt
+        self.qos = qos
+        self.entries = []
+        self.started = 0
+        self.scheduler = scheduler
+        self.clock = scheduler.clock if scheduler is not None else Scheduler.monotonic
+        self.timer = None
+
+    def encode(self, entries):
+        if self.format == 'json':
+            return json.dumps(entries)
+        elif self.format == 'zlib':
+            return zlib.compress(json.dumps(entries, separators=(',', ':')).encode('utf-8'))
+
+        data = bytearray()
+        for entry in entries:
+            packed = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+            data += struct.pack('>I', len(packed))
+            data += packed
+        return bytes(data)
+
+    def publish(self, record):
+        now = self.clock()
+        if not self.entries:
+            self.started = now
+            if self.window and self.scheduler is not None:
+                self.timer = self.scheduler.call_later(self.window, self.flush)
+        self.entries.append({"time": time.time(), "data": record.to_dict()})
+
+        if len(self.entries) >= self.size or (self.window and now - self.started >= self.window):
+            self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.entries:
+            return
+
+        payload = self.encode(self.entries)
+        logging.debug('Publishing batch of %d records (%d bytes) to MQTT on channel %s',
+                      len(self.entries), len(payload), self.topic)
+        self.client.publish(self.topic, payload, qos=self.qos)
+        self.entries = []
+
+
+class Window(object):
+    """
+    Running min/max/sum/last per numeric column over one aggregation window, updated in O(1) per value.
+    """
+    __slots__ = ('seconds', 'name', 'start', 'deadline', 'timer', 'schema', 'count', 'mins', 'maxs', 'sums', 'counts',
+                 'lasts')
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        if seconds % 3600 == 0:
+            self.name = '%dh' % (seconds // 3600)
+        elif seconds % 60 == 0:
+            self.name = '%dm' % (seconds // 60)
+        else:
+            self.name = '%ds' % seconds
+        self.timer = None
+        self.reset(None, None)
+
+    def reset(self, start, schema, deadline=None):
+        columns = len(schema) if schema is not None else 0
+        self.start = start
+        self.deadline = deadline
+        self.schema = schema
+        self.count = 0
+        self.mins = [float('inf')] * columns
+        self.maxs = [float('-inf')] * columns
+        self.sums = [0] * columns
+        self.counts = [0] * columns
+        self.lasts = [None] * columns
+
+    def add(self, values, indexes):
+        self.count += 1
+        for i in indexes:
+            value = values[i]
+            if not isinstance(value, (int, float)):
+                continue
+            if value < self.mins[i]:
+                self.mins[i] = value
+            if value > self.maxs[i]:
+                self.maxs[i] = value
+            self.sums[i] += value
+            self.counts[i] += 1
+            self.lasts[i] = value
+
+    def to_dict(self, partial=False):
+        data = dict((name, {"min": self.mins[i], "max": self.maxs[i], "mean": self.sums[i] / float(self.counts[i]),
+                            "last": self.lasts[i]})
+                    for i, name in enumerate(self.schema.names) if self.counts[i])
+        result = {"start": self.start, "end": self.start + self.seconds, "count": self.count, "data": data}
+        if partial:
+            result["partial"] = True
+        return result
+
+
+class AggregatePublisher(object):
+    """
+    Publishes min, max, mean and last of the numeric fields per time window on <topic>/agg/<window>.
+
+    Windows are given in seconds and aligned to the wall clock, e.g. [60, 3600] publishes on <topic>/agg/1m and
+    <topic>/agg/1h. A window ends on the monotonic clock, so a jump of the wall clock does not cut it short or hold it
+    up: with a 'scheduler' (the Scheduler of the unit) a timer publishes it when it ends, without one the next record
+    after its end does. 'fields' limits the aggregated fields (case insensitive), all numeric fields by default.
+    Windows that are not finished yet are published with "partial": true on flush or when the columns change.
+    """
+
+    def __init__(self, client, topic, windows, fields=None, qos=0, scheduler=None):
+        self.client = client
+        self.topic = topic + '/agg/'
+        self.qos = qos
+        self.windows = [Window(seconds) for seconds in windows]
+        self.fields = set(name.lower() for name in fields) if fields else None
+        self.schema = None
+        self.indexes = ()
+        self.scheduler = scheduler
+        self.clock = scheduler.clock if scheduler is not None else Scheduler.monotonic
+
+    def __open(self, window, now, schema):
+        wall = time.time()
+        remaining = window.seconds - wall % window.seconds
+        window.reset(wall - wall % window.seconds, schema, now + remaining)
+        if self.scheduler is not None:
+            window.timer = self.scheduler.call_later(remaining, self.__close, window)
+
+    def __close(self, window, partial=False):
+        if window.timer is not None:
+            window.timer.cancel()
+            window.timer = None
+        if window.count:
+            topic = self.topic + window.name
+            logging.debug('Publishing aggregate of %d records to MQTT on channel %s', window.count, topic)
+            self.client.publish(topic, json.dumps(window.to_dict(partial)), qos=self.qos)
+        window.reset(None, None)
+
+    def publish(self, record):
+        now = self.clock()
+        if record.schema is not self.schema:
+            self.schema = record.schema
+            self.indexes = tuple(i for i, name in enumerate(record.schema.names)
+                                 if self.fields is None or name.lower() in self.fields)
+
+        for window in self.windows:
+            if window.count and now >= window.deadline:
+                self.__close(window)
+            elif window.count and window.schema is not record.schema:
+                self.__close(window, True)
+            if not window.count:
+                self.__open(window, now, record.schema)
+            window.add(record.values, self.indexes)
+
+    def flush(self):
+        for window in self.windows:
+            self.__close(window, True)
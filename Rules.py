@@ -0,0 +1,152 @@
+from __future__ import print_function
+
+import logging
+import operator
+import re
+
+import Scheduler
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+# Inventum method per action
+ACTIONS = {
+    'FAN=1': 'set_command_fan_high',
+    'FAN=0': 'set_command_fan_auto',
+}
+
+# <field> [(+|-) <field>] <operator> <number> [for <seconds>] -> <action>, the + and - need spaces around them as
+# field names may contain a '-'
+SYNTAX = re.compile(r'^\s*(?P<left>[^\s<>=!]+)(?:\s+(?P<sign>[-+])\s+(?P<right>[^\s<>=!]+))?'
+                    r'\s*(?P<operator>>=|<=|==|!=|>|<)\s*(?P<threshold>-?[0-9]+(?:\.[0-9]*)?)'
+                    r'(?:\s+for\s+(?P<duration>[0-9]+(?:\.[0-9]*)?))?\s*->\s*(?P<action>\S+)\s*$', re.IGNORECASE)
+
+
+class Rule(object):
+    """
+    A condition on the fields of a datalogger record that triggers an action once it held for 'duration' seconds.
+
+    A rule fires once and is armed again when its condition no longer holds, so it does not fight a command given
+    by hand. Hysteresis is a pair of rules, e.g. FAN=1 above 70 and FAN=0 below 60. While a FAN=1 rule that fired
+    still holds the fan is not reset to auto after 'reset_after' minutes.
+    """
+    __slots__ = ('name', 'text', 'left', 'sign', 'right', 'compare', 'threshold', 'duration', 'action',
+                 'positions', 'since', 'fired')
+
+    def __init__(self, name, text, left, sign, right, compare, threshold, duration, action):
+        self.name = name
+        self.text = text
+        self.left = left
+        self.sign = sign
+        self.right = right
+        self.compare = compare
+        self.threshold = threshold
+        self.duration = duration
+        self.action = action
+        self.positions = None
+        self.since = None
+        self.fired = False
+
+    @classmethod
+    def parse(cls, name, text):
+        match = SYNTAX.match(text)
+        if match is None:
+            raise ValueError('Invalid rule %s: %s' % (name, text))
+        action = match.group('action').upper()
+        if action not in ACTIONS:
+            raise ValueError('Invalid action in rule %s: %s' % (name, action))
+        return cls(name, text.strip(), match.group('left'), match.group('sign'), match.group('right'),
+                   OPERATORS[match.group('operator')], float(match.group('threshold')),
+                   float(match.group('duration') or 0), action)
+
+    @property
+    def fields(self):
+        return (self.left, self.right) if self.right else (self.left,)
+
+    def bind(self, schema):
+        """
+        Look up the positions of the fields in a new header. A rule on a field the header lacks never holds.
+        """
+        positions = tuple(schema.positions.get(field) for field in self.fields)
+        self.positions = None if None in positions else positions
+        return self.positions is not None
+
+    def holds(self, values):
+        positions = self.positions
+        if positions is None:
+            return False
+        value = values[positions[0]]
+        if self.sign is not None:
+            other = values[positions[1]]
+            if not isinstance(other, (int, float)):
+                return False
+            value = value - other if self.sign == '-' else value + other
+        return isinstance(value, (int, float)) and self.compare(value, self.threshold)
+
+    def check(self, values, now):
+        """
+        True when the rule fires with this record.
+        """
+        if not self.holds(values):
+            self.since = None
+            self.fired = False
+            return False
+        if self.since is None:
+            self.since = now
+        if self.fired or now - self.since < self.duration:
+            return False
+        self.fired = True
+        return True
+
+
+class RuleEngine(object):
+    """
+    Evaluates the rules on every datalogger record, from the workflow thread. The field positions are looked up
+    once per header, a record costs a comparison per rule.
+    """
+
+    def __init__(self, rules, clock=Scheduler.monotonic):
+        self.rules = list(rules)
+        self.clock = clock
+        self.schema = None
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __bind(self, schema):
+        self.schema = schema
+        for rule in self.rules:
+            if not rule.bind(schema):
+                logging.warning('Rule %s uses fields that are not in the datalogger header: %s', rule.name,
+                                ', '.join(field for field in rule.fields if field not in schema.positions))
+
+    def active(self, action):
+        """
+        True while a rule with 'action' fired and its condition still holds.
+        """
+        return any(rule.fired and rule.action == action for rule in self.rules)
+
+    def evaluate(self, record, inventum):
+        """
+        Run the actions of the rules that fire with 'record' on 'inventum' and return those rules.
+        """
+        if record.schema is not self.schema:
+            self.__bind(record.schema)
+        now = self.clock()
+        fired = [rule for rule in self.rules if rule.check(record.values, now)]
+        for rule in fired:
+            getattr(inventum, ACTIONS[rule.action])()
+        return fired
+
+
+def create(options, clock=Scheduler.monotonic):
+    """
+    RuleEngine of (name, rule) pairs, e.g. the options of the [rules] section.
+    """
+    return RuleEngine((Rule.parse(name, text) for name, text in options), clock)
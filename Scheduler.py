@@ -0,0 +1,97 @@
+from __future__ import print_function
+
+import heapq
+import itertools
+import time
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Timer(object):
+    """
+    A callback registered with the Scheduler, cancel() it when it is no longer needed.
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled', 'scheduler')
+
+    def __init__(self, scheduler, deadline, callback, args):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler.cancelled += 1
+
+
+class Scheduler(object):
+    """
+    Deadlines of the state machine in a heap, on a monotonic clock so a jump of the wall clock does not fire or
+    hold up a timeout. The loop sleeps for timeout() and calls run_due(), a timer costs O(log n) to register and
+    nothing while it waits.
+
+    Cancelled timers stay in the heap until they reach the top, the heap is rebuilt when they are the majority.
+    Pass a 'clock' of your own to step through time in tests.
+    """
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.heap = []
+        self.cancelled = 0
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(self, deadline, callback, args)
+        heapq.heappush(self.heap, (deadline, next(self.sequence), timer))
+        if self.cancelled > 32 and self.cancelled * 2 > len(self.heap):
+            # In place, run_due() may be calling us from a callback while it holds on to the heap
+            self.heap[:] = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+        return timer
+
+    def __drop_cancelled(self):
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+
+    def next_deadline(self):
+        self.__drop_cancelled()
+        return self.heap[0][0] if self.heap else None
+
+    def timeout(self, maximum=None):
+        """
+        Seconds until the next deadline, at most 'maximum'. None when nothing is scheduled and there is no maximum.
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return maximum
+        timeout = max(0.0, deadline - self.clock())
+        return timeout if maximum is None else min(timeout, maximum)
+
+    def run_due(self):
+        """
+        Call the callbacks of the timers whose deadline passed, in deadline order. Returns how many ran.
+        """
+        now = self.clock()
+        heap = self.heap
+        count = 0
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            # A fired timer can not be cancelled any more
+            timer.cancelled = True
+            timer.callback(*timer.args)
+            count += 1
+        return count
@@ -0,0 +1,336 @@
+#!/usr/bin/python -tt
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import select
+import sys
+import time
+import tty
+
+import DataLogger
+
+FIELDS = ['Temp. (buiten)', 'Temp. (afvoer)', 'Temp. (toevoer)', 'Temp. (boiler boven)', 'Temp. (boiler onder)',
+          'Temp. (verdamper)', 'Temp. (persgas)', 'Temp. (zuiggas)', 'Druk (hoog)', 'Druk (laag)', 'Vocht (afvoer)',
+          'Debiet (afvoer)', 'Debiet (toevoer)', 'Toerental (afvoer)', 'Toerental (toevoer)', '3-standen',
+          'Compressor', 'Element', 'Klep (bypass)', 'Klep (4-weg)', 'Storing', 'Bedrijfsuren']
+
+IO_MENU = ['Compressor', 'Element', 'Klep bypass', 'Klep 4-weg', 'Ventilator afvoer', 'Ventilator toevoer',
+           'Pomp', 'Storing', 'Alarm', 'Relais 1', 'Relais 2', 'Ingang 1', 'Ingang 2', 'Ingang 3', 'Vorst',
+           'Boiler', '3-standen', 'Zomerbypass', 'Filter']
+
+EXTRA_MENU = ['1 Instellingen', '2 Tijd en datum', '3 Storingshistorie', '4 Bedrijfsuren', '5 Test',
+              '6 IO status', '7 Reset', '8 Software versie', '9 Datalogger']
+
+
+def sample_header():
+    """
+    Build a datalogger header of exactly the size the device sends, with a status and a value column per field.
+    """
+    columns = []
+    i = 0
+    while len(', '.join(columns)) < DataLogger.DataLoggerParser.HEADER_LENGTH - 80:
+        name = FIELDS[i % len(FIELDS)] + ('' if i < len(FIELDS) else ' ' + str(i // len(FIELDS)))
+        columns += ['St. ' + name, name]
+        i += 1
+    header = ', '.join(columns).ljust(DataLogger.DataLoggerParser.HEADER_LENGTH - 1)
+    return header.encode('latin-1') + b'\r\n', i
+
+
+def sample_marker():
+    return b'Interval: 10 sec'.ljust(DataLogger.DataLoggerParser.MARKER_LENGTH - 2) + b'\r\n'
+
+
+def sample_values(num_fields, rnd):
+    return [rnd.randint(0, 450) for _ in range(num_fields)]
+
+
+def sample_record(values, rnd, fan=1):
+    """
+    Next record of a slowly drifting set of sensor values, like the real unit produces.
+    """
+    fields = []
+    for i in range(len(values)):
+        if FIELDS[i % len(FIELDS)] == '3-standen':
+            fields += ['0', str(fan)]
+        else:
+            if rnd.random() < 0.1:
+                values[i] += rnd.choice((-1, 1))
+            fields += ['0', str(values[i])]
+    return ','.join(fields).encode('latin-1') + b'\r\n'
+
+
+def at(row, col=1):
+    return ('\033[%d;%dH' % (row, col)).encode('latin-1')
+
+
+def io_status_row(item, selected, fan):
+    value = fan if IO_MENU[item - 1] == '3-standen' else item % 2
+    line = (' I%02d %-20s: %d' % (item, IO_MENU[item - 1], value)).ljust(40).encode('latin-1')
+    sgr = b'\033[7m' if item == selected else b'\033[0m'
+    return sgr + at(item + 2) + line + b'\033[K\033[0m'
+
+
+def io_status_screen(selected, fan=1):
+    """
+    A full redraw of the IO status menu with menu item 'selected' highlighted, as sent by the unit.
+    """
+    out = [b'\033[0m\033[2J\033[1;1H IO status', at(2) + b'-' * 79]
+    out += [io_status_row(item, selected, fan) for item in range(1, len(IO_MENU) + 1)]
+    out.append(at(53) + b' ESC=terug')
+    return b''.join(out)
+
+
+class EcolutionDevice(object):
+    """
+    Model of the terminal interface of an Inventum Ecolution: login, the extra menu, the IO status menu with the
+    '3-standen' edit screen and the datalogger. Keys go in through receive(), terminal output is collected in
+    'output'. Datalogger records are produced by tick() at 'rate' records per second.
+    """
+
+    SCREEN_LOGIN = 'login'
+    SCREEN_CHALLENGE = 'challenge'
+    SCREEN_EXTRA_MENU = 'extra menu'
+    SCREEN_IO_STATUS = 'io status'
+    SCREEN_EDIT_FAN = 'edit fan'
+    SCREEN_DATALOGGER = 'datalogger'
+
+    LOGIN_CODE = '3845'
+    PIN_CODE = '19'
+    FAN_AUTO = 1
+    BACKLOG = 4096
+
+    def __init__(self, rate=0.1, seed=1, clock=time.time):
+        self.clock = clock
+        self.rate = rate
+        self.rnd = random.Random(seed)
+        self.header, num_fields = sample_header()
+        self.values = sample_values(num_fields, self.rnd)
+        self.output = bytearray()
+        self.screen = None
+        self.typed = ''
+        self.selected = 1
+        self.fan = self.FAN_AUTO
+        self.fan_changed_at = None
+        self.next_record = 0
+        self.records = 0
+        self.show_login()
+
+    def send(self, data):
+        self.output += data
+
+    def take(self, size=-1):
+        if size < 0:
+            size = len(self.output)
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        return data
+
+    def show_login(self):
+        self.screen = self.SCREEN_LOGIN
+        self.typed = ''
+        self.send(b'\033[0m\033[2J\033[1;1H Inventum Ecolution' + at(10) + b'Voer code in: ')
+
+    def show_challenge(self):
+        self.screen = self.SCREEN_CHALLENGE
+        self.typed = ''
+        self.send(at(10) + b'\033[KVoer beveiligingscode in: ')
+
+    def show_extra_menu(self):
+        self.screen = self.SCREEN_EXTRA_MENU
+        out = [b'\033[0m\033[2J\033[1;1H Inventum Ecolution', at(2) + b' EXTRAMENU']
+        out += [at(i + 4) + b' ' + item.encode('latin-1') for i, item in enumerate(EXTRA_MENU)]
+        out.append(at(53) + b' Keuze: ')
+        self.send(b''.join(out))
+
+    def show_io_status(self):
+        self.screen = self.SCREEN_IO_STATUS
+        self.send(io_status_screen(self.selected, self.fan))
+
+    def show_edit_fan(self):
+        self.screen = self.SCREEN_EDIT_FAN
+        self.typed = ''
+        self.send(at(51) + b'\033[K   3-standen : ')
+
+    def start_datalogger(self):
+        self.screen = self.SCREEN_DATALOGGER
+        self.send(b'\033[0m\033[2J\033[1;1H' + sample_marker() + self.header)
+        self.next_record = self.clock()
+
+    def set_fan(self, value):
+        self.fan = value
+        self.fan_changed_at = self.clock()
+
+    def key_char(self, c):
+        if self.screen in (self.SCREEN_LOGIN, self.SCREEN_CHALLENGE, self.SCREEN_EDIT_FAN):
+            self.send(c.encode('latin-1'))
+            self.typed += c
+        elif self.screen == self.SCREEN_EXTRA_MENU:
+            self.send(c.encode('latin-1'))
+            if c == '6':
+                self.show_io_status()
+            elif c == '9':
+                self.start_datalogger()
+
+    def key_enter(self):
+        if self.screen == self.SCREEN_LOGIN:
+            if self.typed == self.LOGIN_CODE:
+                self.show_challenge()
+            else:
+                self.show_login()
+        elif self.screen == self.SCREEN_CHALLENGE:
+            if self.typed == self.PIN_CODE:
+                self.show_extra_menu()
+            else:
+                self.show_login()
+        elif self.screen == self.SCREEN_IO_STATUS:
+            if IO_MENU[self.selected - 1] == '3-standen':
+                self.show_edit_fan()
+        elif self.screen == self.SCREEN_EDIT_FAN:
+            if self.typed in ('1', '2', '3'):
+                self.set_fan(int(self.typed))
+            self.send(at(51) + b'\033[K')
+            self.show_io_status()
+
+    def key_escape(self):
+        if self.screen in (self.SCREEN_LOGIN, self.SCREEN_CHALLENGE, self.SCREEN_EXTRA_MENU):
+            self.show_login()
+        elif self.screen == self.SCREEN_IO_STATUS:
+            self.show_extra_menu()
+        elif self.screen == self.SCREEN_EDIT_FAN:
+            self.set_fan(self.FAN_AUTO)
+            self.send(at(51) + b'\033[K')
+            self.show_io_status()
+        elif self.screen == self.SCREEN_DATALOGGER:
+            self.show_extra_menu()
+
+    def key_move(self, step):
+        if self.screen != self.SCREEN_IO_STATUS:
+            return
+        previous = self.selected
+        self.selected = min(max(self.selected + step, 1), len(IO_MENU))
+        if previous != self.selected:
+            self.send(io_status_row(previous, self.selected, self.fan) +
+                      io_status_row(self.selected, self.selected, self.fan))
+
+    def receive(self, data):
+        i = 0
+        while i < len(data):
+            c = data[i:i + 1]
+            i += 1
+            if c == b'\033':
+                if data[i:i + 1] == b'[' and i + 1 < len(data):
+                    key = data[i + 1:i + 2]
+                    i += 2
+                    if key == b'A':
+                        self.key_move(-1)
+                    elif key == b'B':
+                        self.key_move(1)
+                else:
+                    self.key_escape()
+            elif c == b'\r':
+                self.key_enter()
+            else:
+                self.key_char(c.decode('latin-1'))
+
+    def tick(self, now=None):
+        if self.screen != self.SCREEN_DATALOGGER or self.rate <= 0:
+            return
+        now = self.clock() if now is None else now
+        while now >= self.next_record and len(self.output) < self.BACKLOG:
+            self.send(sample_record(self.values, self.rnd, self.fan))
+            self.next_record += 1.0 / self.rate
+            self.records += 1
+        if now >= self.next_record:
+            # The line can not keep up, records are produced as fast as the baud rate allows
+            self.next_record = now
+
+
+class SimulatedPort(object):
+    """
+    In-process stand-in for serial.Serial connected to an EcolutionDevice, for tests and benchmarks.
+    """
+
+    def __init__(self, device=None):
+        self.device = device or EcolutionDevice()
+
+    def inWaiting(self):
+        self.device.tick()
+        return len(self.device.output)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def read(self, size=1):
+        self.device.tick()
+        return self.device.take(size)
+
+    def write(self, data):
+        self.device.receive(data)
+        return len(data)
+
+    def flushInput(self):
+        self.device.take()
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def run_pty(device, link=None, baudrate=9600):
+    """
+    Serve the device on a pseudo terminal, output is limited to what 'baudrate' can carry.
+    """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    name = os.ttyname(slave)
+    if link:
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(name, link)
+        name = link
+    print('Simulating Inventum Ecolution on %s' % name)
+    sys.stdout.flush()
+
+    bytes_per_second = baudrate / 10.0
+    budget = 0
+    last = time.time()
+    try:
+        while True:
+            ready, _, _ = select.select([master], [], [], 0.01 if device.output else 0.05)
+            if ready:
+                device.receive(os.read(master, 1024))
+
+            now = time.time()
+            device.tick(now)
+            budget = min(budget + (now - last) * bytes_per_second, bytes_per_second)
+            last = now
+
+            size = min(len(device.output), int(budget)) if baudrate else len(device.output)
+            if size:
+                ready, writable, _ = select.select([], [master], [], 0)
+                if writable:
+                    written = os.write(master, bytes(device.output[:size]))
+                    del device.output[:written]
+                    budget -= written
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if link and os.path.islink(link):
+            os.remove(link)
+        os.close(master)
+        os.close(slave)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate an Inventum Ecolution on a pseudo terminal')
+    parser.add_argument('--rate', type=float, default=0.1, help='datalogger records per second')
+    parser.add_argument('--baudrate', type=int, default=9600, help='line speed, 0 for unlimited')
+    parser.add_argument('--link', help='symlink to create for the pseudo terminal, e.g. /tmp/ttyInventum')
+    args = parser.parse_args()
+
+    run_pty(EcolutionDevice(rate=args.rate), args.link, args.baudrate)
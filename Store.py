@@ -0,0 +1,179 @@
+from __future__ import print_function
+
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+class Segment(object):
+    """
+    One segment file: a magic, the JSON encoded column names and then fixed width rows of a little endian double
+    timestamp and a float per column. Text values and missing values are stored as NaN.
+    """
+
+    MAGIC = b'INVSTOR1'
+    LENGTH = struct.Struct('<I')
+
+    def __init__(self, path, names, offset):
+        self.path = path
+        self.names = tuple(names)
+        self.offset = offset
+        self.row = struct.Struct('<d%df' % len(self.names))
+
+    @classmethod
+    def create(cls, path, names):
+        header = json.dumps({'columns': list(names)}).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(cls.MAGIC + cls.LENGTH.pack(len(header)) + header)
+        return cls(path, names, len(cls.MAGIC) + cls.LENGTH.size + len(header))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError('Not a store segment: %s' % path)
+            length, = cls.LENGTH.unpack(f.read(cls.LENGTH.size))
+            names = json.loads(f.read(length).decode('utf-8'))['columns']
+        return cls(path, names, len(cls.MAGIC) + cls.LENGTH.size + length)
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def rows(self, size):
+        return (size - self.offset) // self.row.size
+
+    def query(self, start, end, fields, limit):
+        """
+        Rows with start <= time < end as dicts of 'time' and the requested fields, at most 'limit' of them.
+        """
+        indexes = [(name, self.names.index(name)) for name in (fields or self.names) if name in self.names]
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            count = self.rows(size)
+            if count <= 0:
+                return []
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            time_at = lambda i: struct.unpack_from('<d', data, self.offset + i * self.row.size)[0]
+            if (start is not None and time_at(count - 1) < start) or (end is not None and time_at(0) >= end):
+                return []
+
+            # Rows are appended in time order, find the first one in range with a binary search
+            lo, hi = 0, count
+            while start is not None and lo < hi:
+                mid = (lo + hi) // 2
+                if time_at(mid) < start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            result = []
+            for i in range(lo, count):
+                if limit is not None and len(result) >= limit:
+                    break
+                row = self.row.unpack_from(data, self.offset + i * self.row.size)
+                if end is not None and row[0] >= end:
+                    break
+                entry = dict((name, None if math.isnan(row[index + 1]) else row[index + 1])
+                             for name, index in indexes)
+                entry['time'] = row[0]
+                result.append(entry)
+            return result
+        finally:
+            data.close()
+
+
+class TimeSeriesStore(object):
+    """
+    Append-only store of datalogger records in a directory of numbered segment files.
+
+    A new segment is started when the current one grows past 'segment_size' bytes or the datalogger header
+    changes. The oldest segments are removed once the store is larger than 'max_size' bytes, 0 keeps everything.
+    Queries read the segments through mmap and can run on another thread than the one appending.
+    """
+
+    SUFFIX = '.seg'
+
+    def __init__(self, directory, segment_size=1 << 20, max_size=64 << 20):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.current = None
+        self.file = None
+        self.written = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __segment_paths(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(self.SUFFIX))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def __next_path(self):
+        paths = self.__segment_paths()
+        number = int(os.path.basename(paths[-1])[:-len(self.SUFFIX)]) + 1 if paths else 0
+        return os.path.join(self.directory, '%08d%s' % (number, self.SUFFIX))
+
+    def __roll(self, names):
+        if self.file is not None:
+            self.file.close()
+        self.current = Segment.create(self.__next_path(), names)
+        self.file = open(self.current.path, 'ab')
+        self.written = self.current.offset
+        self.__apply_retention()
+
+    def __apply_retention(self):
+        if not self.max_size:
+            return
+        paths = self.__segment_paths()
+        sizes = [os.path.getsize(path) for path in paths]
+        total = sum(sizes)
+        for path, size in zip(paths, sizes):
+            if total <= self.max_size or path == self.current.path:
+                break
+            logging.info('Store retention: removing segment %s', path)
+            os.remove(path)
+            total -= size
+
+    def append(self, record, timestamp=None):
+        values = [float(v) if isinstance(v, (int, float)) else float('nan') for v in record.values]
+        with self.lock:
+            if self.current is None or self.current.names != record.schema.names or \
+                    self.written >= self.segment_size:
+                self.__roll(record.schema.names)
+            row = self.current.row.pack(time.time() if timestamp is None else timestamp, *values)
+            self.file.write(row)
+            self.file.flush()
+            self.written += len(row)
+
+    def query(self, start=None, end=None, fields=None, limit=None):
+        """
+        Stored rows with start <= time < end, oldest first, each a dict of 'time' and the requested fields.
+        """
+        with self.lock:
+            paths = self.__segment_paths()
+
+        result = []
+        for path in paths:
+            try:
+                segment = self.current if self.current and self.current.path == path else Segment.load(path)
+                result += segment.query(start, end, fields, None if limit is None else limit - len(result))
+            except (IOError, OSError, ValueError) as e:
+                # Removed by retention in the mean time, or not a segment at all
+                logging.debug('Store: skipping %s: %s', path, e)
+            if limit is not None and len(result) >= limit:
+                break
+        return result
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.current = None
@@ -1,87 +1,403 @@
 from __future__ import print_function
 
+import collections
+import re
+import select
 import serial
 import sys
+import threading
 import time
 
+import Scheduler
+import Trace
+
+
+class RingBuffer(object):
+    """
+    Bounded byte FIFO between the serial reader thread and the workflow thread.
+
+    When the buffer is full the incoming bytes that do not fit are dropped and counted as overrun, so a stalled
+    consumer shows up in the counters instead of as unbounded memory use.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = bytearray(capacity)
+        self.head = 0
+        self.size = 0
+        self.lock = threading.Lock()
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.bytes_dropped = 0
+        self.overruns = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, chunk):
+        with self.lock:
+            accepted = min(len(chunk), self.capacity - self.size)
+            if accepted < len(chunk):
+                self.overruns += 1
+                self.bytes_dropped += len(chunk) - accepted
+
+            tail = (self.head + self.size) % self.capacity
+            first = min(accepted, self.capacity - tail)
+            self.data[tail:tail + first] = chunk[:first]
+            self.data[0:accepted - first] = chunk[first:accepted]
+
+            self.size += accepted
+            self.bytes_written += accepted
+            self.high_water = max(self.high_water, self.size)
+            return accepted
+
+    def read(self, length=-1):
+        with self.lock:
+            length = self.size if length < 0 else min(length, self.size)
+            first = min(length, self.capacity - self.head)
+            data = bytes(self.data[self.head:self.head + first]) + bytes(self.data[0:length - first])
+
+            self.head = (self.head + length) % self.capacity
+            self.size -= length
+            self.bytes_read += length
+            return data
+
+    def clear(self):
+        with self.lock:
+            self.head = 0
+            self.size = 0
+
+    def stats(self):
+        return {
+            'bytes_received': self.bytes_written,
+            'buffer_occupancy': self.size,
+            'buffer_high_water': self.high_water,
+            'buffer_capacity': self.capacity,
+            'bytes_dropped': self.bytes_dropped,
+            'overruns': self.overruns,
+        }
+
+
+class PortError(Exception):
+    """
+    The serial port failed while reading or writing, raised instead of the error of the port so it can not be
+    mistaken for an OSError of the code that handles the data.
+    """
+
 
 class TermSerial:
     ESC = b'\033'
     CSI = b'['
+    CR = b'\r'
+    LF = b'\n'
+
+    TEXT = re.compile(b'[^\033\r\n]+')
+    PARAMETERS = re.compile(b'[0-9;]+')
 
-    def __init__(self, device, rows=53, cols=80, baudrate=9600, parity=serial.PARITY_NONE, timeout=10):
+    ECHO_TIMEOUT = 2.0  # seconds the unit gets to echo a typed character
+
+    ERRORS = (serial.SerialException, OSError, IOError)  # raised when the port went away
+
+    def __init__(self, device, rows=53, cols=80, baudrate=9600, parity=serial.PARITY_NONE, timeout=10, connect=True):
         self.device = device
-        self.serial = TermSerial._get_serial(device, baudrate, parity, timeout)
+        self.baudrate = baudrate
+        self.parity = parity
+        self.timeout = timeout
+        self.serial = None
         self.row = 0
         self.col = 0
         self.rows = rows
         self.cols = cols
-        self.buffer = [b' ' for _ in xrange(rows * cols)]
+        self.size = rows * cols
+        self.blank = b' ' * self.size
+        self.buffer = bytearray(self.blank)
         self.mode = 0
-        self.chars = ''
+        self.chars = b''
         self.sgr = 0
-        self.sgr_line = [0 for _ in xrange(rows)]
+        self.sgr_line = bytearray(rows)
+        self.dirty = bytearray(b'\x01' * rows)
+        self.generation = 0
+        self.raw = bytearray()
+        self.quiet = False
+        self.tx = bytearray()
+        self.tx_lock = threading.Lock()
+        self.nonblocking = False
+        self.pending_echo = collections.deque()
+        self.echo_matched = 0
+        self.echo_mismatches = 0
+        self.echo_timeouts = 0
+        self.writes = 0
+        self.write_latency = 0.0
+        self.write_latency_max = 0.0
+        self.write_latency_total = 0.0
+        self.bytes_read = 0
+        self.ring = None
+        self.reader = None
+        self.reader_timeout = None
+        self.reader_error = None
+        self.on_receive = None
+        self.trace = None
         self.keep_running = True
+        if connect:
+            self.open()
+
+    @property
+    def connected(self):
+        return self.serial is not None
+
+    def open(self):
+        self.serial = self._get_serial(self.device, self.baudrate, self.parity, self.timeout)
+        if self.nonblocking and self.write_fileno() is not None:
+            self.serial.write_timeout = 0
+        if self.trace is not None:
+            self.serial = Trace.TracingPort(self.serial, self.trace)
+        if self.ring is not None:
+            self.__start_reader_thread()
+
+    def start_trace(self, path):
+        """
+        Record everything read from and written to the port, with its time, in the trace file 'path'. The trace
+        can be played back with the device 'replay:<path>'.
+        """
+        self.trace = Trace.TraceWriter(path)
+        if self.serial is not None:
+            self.serial = Trace.TracingPort(self.serial, self.trace)
+
+    def disconnect(self):
+        """
+        Drop the port after it failed. Keys that were not sent yet are discarded, the screen is kept.
+        """
+        self.stop_reader()
+        port, self.serial = self.serial, None
+        if port is not None:
+            try:
+                port.close()
+            except self.ERRORS:
+                pass
+        with self.tx_lock:
+            del self.tx[:]
+        self.pending_echo.clear()
+
+    def reopen(self):
+        self.disconnect()
+        self.open()
+        self.reset()
 
     def reset(self):
-        self.serial.flushInput()
-        self.serial.flushOutput()
+        try:
+            self.serial.flushInput()
+            self.serial.flushOutput()
+        except self.ERRORS as e:
+            raise PortError(e)
+        if self.ring is not None:
+            self.ring.clear()
 
         self.row = 0
         self.col = 0
-        self.buffer = [b' ' for _ in xrange(self.rows * self.cols)]
+        self.buffer[:] = self.blank
         self.mode = 0
-        self.chars = ''
+        self.chars = b''
         self.sgr = 0
-        self.sgr_line = [0 for _ in xrange(self.rows)]
+        self.sgr_line[:] = bytearray(self.rows)
+        self.mark_dirty()
+        self.raw = bytearray()
+        self.pending_echo.clear()
         self.keep_running = True
 
     def interrupt(self):
+        # Leave the menus; the escapes go out with the flush in close() on the thread driving this port, so the
+        # caller (MQTT thread or event loop shared with other units) is not held up
         self.keep_running = False
         self.key_escape()
         self.key_escape()
-        time.sleep(4)
-        self.reset()
 
     # def dump(self):
-    #     for row in xrange(self.rows):
-    #         print(str(self.sgr_line[row]) + '~' + str(row + 1).rjust(2) + ': ' + ''.join(
-    #             self.buffer[row * self.cols: (row + 1) * self.cols - 1]))
+    #     for row in range(self.rows):
+    #         print(str(self.sgr_line[row]) + '~' + str(row + 1).rjust(2) + ': ' + self.get_row(row + 1))
     #         if row == self.row:
-    #             print('      ' + ''.join([' ' for _ in xrange(self.col)]) + '^')
+    #             print('      ' + ' ' * self.col + '^')
 
     def set_raw_mode(self):
         self.mode = -1
+        self.raw = bytearray()
 
     def has_raw_data(self):
-        return len(self.buffer) > 0
+        return len(self.raw) > 0
 
     def get_raw_data(self):
-        data = self.buffer
-        self.buffer = []
+        data = self.raw
+        self.raw = bytearray()
         return data
 
     def set_normal_mode(self):
         self.reset()
 
+    def start_reader(self, capacity=65536, timeout=0.5):
+        """
+        Move reading the port to a thread that drains it into a RingBuffer of 'capacity' bytes, so a slow
+        workflow or MQTT broker does not leave bytes waiting in the USB CDC buffer.
+        """
+        self.ring = RingBuffer(capacity)
+        self.reader_timeout = timeout
+        if self.serial is not None:
+            self.__start_reader_thread()
+
+    def __start_reader_thread(self):
+        self.serial.timeout = self.reader_timeout
+        self.reader_error = None
+        self.reader = threading.Thread(target=self.__reader_loop, name='serial-reader')
+        self.reader.daemon = True
+        self.reader.start()
+
+    def stop_reader(self):
+        reader = self.reader
+        self.reader = None
+        if reader is not None and reader is not threading.current_thread():
+            reader.join(self.reader_timeout * 2)
+
+    def __reader_loop(self):
+        try:
+            while self.reader is not None:
+                data = self.serial.read(max(1, self.serial.inWaiting()))
+                if data:
+                    self.ring.write(data)
+                    if self.on_receive:
+                        self.on_receive()
+                else:
+                    time.sleep(0.01)
+        except Exception as e:
+            self.reader_error = e
+            if self.on_receive:
+                self.on_receive()
+
     def has_bytes_waiting(self):
-        return self.serial.inWaiting() > 0
+        if self.ring is not None:
+            if self.reader_error is not None:
+                raise PortError(self.reader_error)
+            return len(self.ring) > 0
+        try:
+            return self.serial.inWaiting() > 0
+        except self.ERRORS as e:
+            raise PortError(e)
 
     def read(self, length=-1):
-        waiting = self.serial.inWaiting()
-        bytes_to_read = min(waiting, length)
-        if length == -1:  # read everything if -1
-            bytes_to_read = waiting
-        return self.serial.read(bytes_to_read)
+        if self.ring is not None:
+            return self.ring.read(length)
+
+        try:
+            waiting = self.serial.inWaiting()
+            bytes_to_read = min(waiting, length)
+            if length == -1:  # read everything if -1
+                bytes_to_read = waiting
+            return self.serial.read(bytes_to_read)
+        except self.ERRORS as e:
+            raise PortError(e)
 
     def writeln(self, value):
         self.write(value)
         self.key_enter()
 
     def write(self, value):
-        for v in value:
-            self.serial.write(v.encode())
-            self.serial.read(1)
+        """
+        Queue typed characters. The unit echoes them, the echoes are checked in the read path.
+        """
+        data = value.encode('latin-1')
+        deadline = Scheduler.monotonic() + self.ECHO_TIMEOUT
+        with self.tx_lock:
+            self.tx += data
+            for i in range(len(data)):
+                self.pending_echo.append((data[i:i + 1], deadline))
+
+    def set_nonblocking(self):
+        """
+        Never block in flush(): only what the port takes right away is written, the rest stays queued until
+        write_fileno() is writable again. For an event loop shared by several ports.
+        """
+        self.nonblocking = True
+        if self.serial is not None and self.write_fileno() is not None:
+            self.serial.write_timeout = 0
+
+    def write_fileno(self):
+        """
+        File descriptor of the port to wait on until queued keystrokes can be written, None if the port has none.
+        """
+        if self.serial is not None and hasattr(self.serial, 'fileno'):
+            return self.serial.fileno()
+        return None
+
+    @property
+    def write_pending(self):
+        return len(self.tx) > 0
+
+    def flush(self):
+        """
+        Send all queued keystrokes in one write.
+        """
+        with self.tx_lock:
+            if not self.tx:
+                return
+            data = bytes(self.tx)
+            fd = self.write_fileno() if self.nonblocking else None
+            try:
+                if fd is not None and not select.select([], [fd], [], 0)[1]:
+                    return
+                written = self.serial.write(data)
+            except self.ERRORS as e:
+                raise PortError(e)
+            if fd is not None and written is not None and written < len(data):
+                self.tx = bytearray(data[written:])
+            else:
+                self.tx = bytearray()
+            self.writes += 1
+
+    def stats(self):
+        stats = {
+            'bytes_read': self.bytes_read,
+            'writes': self.writes,
+            'echo_matched': self.echo_matched,
+            'echo_mismatches': self.echo_mismatches,
+            'echo_timeouts': self.echo_timeouts,
+            'write_latency': self.write_latency,
+            'write_latency_max': self.write_latency_max,
+            'write_latency_mean': self.write_latency_total / self.echo_matched if self.echo_matched else 0.0,
+        }
+        if self.ring is not None:
+            stats.update(self.ring.stats())
+        return stats
+
+    def match_echo(self, chrs):
+        """
+        Match received bytes against the pending echoes and return the positions of the echoed bytes.
+        An echo that is not the next byte received counts as mismatch, an echo that does not arrive in
+        ECHO_TIMEOUT seconds as timeout.
+        """
+        now = Scheduler.monotonic()
+        positions = []
+        pos = 0
+        while self.pending_echo:
+            byte, deadline = self.pending_echo[0]
+            idx = chrs.find(byte, pos)
+            if idx == -1:
+                break
+            if idx != pos:
+                self.echo_mismatches += 1
+            self.pending_echo.popleft()
+            positions.append(idx)
+            pos = idx + 1
+
+            self.write_latency = now - (deadline - self.ECHO_TIMEOUT)
+            self.write_latency_max = max(self.write_latency_max, self.write_latency)
+            self.write_latency_total += self.write_latency
+            self.echo_matched += 1
+
+        self.expire_echo(now)
+        return positions
+
+    def expire_echo(self, now):
+        while self.pending_echo and self.pending_echo[0][1] < now:
+            self.pending_echo.popleft()
+            self.echo_timeouts += 1
 
     def to_idx(self):
         return self.coord_to_idx(self.row + 1, self.col + 1)
@@ -93,10 +409,44 @@ class TermSerial:
         # print('('+str(row)+','+str(col)+') = ' + str(((row - 1) * self.cols) + (col - 1)))
         return ((row - 1) * self.cols) + (col - 1)
 
+    def mark_dirty(self, first=0, last=None):
+        """
+        Flag rows (0-based, inclusive) as changed and bump the screen generation.
+        """
+        first = max(first, 0)
+        last = min(self.rows - 1 if last is None else last, self.rows - 1)
+        if first <= last:
+            self.dirty[first:last + 1] = b'\x01' * (last - first + 1)
+        self.generation += 1
+
+    def take_dirty_rows(self):
+        """
+        Return the dirty row bitmap, indexed by 0-based row, and start a new one.
+        """
+        dirty = self.dirty
+        self.dirty = bytearray(self.rows)
+        return dirty
+
     def set_char(self, c):
-        # print(str(self.to_idx()) + ' - ' + str(ord(c)))
-        self.buffer[self.to_idx()] = c
-        self.col = self.col + 1
+        self.put_text(c)
+
+    def put_text(self, text):
+        """
+        Copy a run of printable characters to the screen at the cursor in one go.
+        """
+        idx = self.to_idx()
+        end = min(idx + len(text), self.size)
+        if idx < end and self.quiet:
+            self.buffer[idx:end] = text[:end - idx]
+        elif idx < end:
+            self.buffer[idx:end] = text[:end - idx]
+            row = idx // self.cols
+            if end <= (row + 1) * self.cols:
+                self.dirty[row] = 1
+                self.generation += 1
+            else:
+                self.mark_dirty(row, (end - 1) // self.cols)
+        self.col = self.col + len(text)
 
     '''
     Rows and columns are 1-based
@@ -104,28 +454,31 @@ class TermSerial:
     def set_cursor(self, row, col):
         self.row = row - 1
         self.col = col - 1
-        self.sgr_line[self.row] = self.sgr
+        self.sgr_line[self.row] = min(self.sgr, 255)
+        self.mark_dirty(self.row, self.row)
 
     def cr(self):
         self.row = self.row + 1
         self.col = 0
+        self.mark_dirty(self.row, self.row)
 
     def nl(self):
         self.col = 0
 
     def clear_screen(self, full=False):
         if full:
-            self.buffer = [' ' for _ in xrange(self.rows * self.cols)]
+            self.buffer[:] = self.blank
+            self.mark_dirty()
         else:
-            num_items = self.rows * self.cols - self.to_idx()
-            self.buffer[self.to_idx():self.rows * self.cols] = [' '] * num_items
+            idx = self.to_idx()
+            self.buffer[idx:] = self.blank[idx:]
+            self.mark_dirty(idx // self.cols)
 
     def selected_row(self):
-        try:
-            r = self.sgr_line.index(7, 2)
-            return self.get_row(r + 1)
-        except:
+        r = self.sgr_line.find(b'\x07', 2)
+        if r == -1:
             return ""
+        return self.get_row(r + 1)
 
     '''
     Rows and columns are 1-based
@@ -133,74 +486,136 @@ class TermSerial:
     def get_row(self, row):
         start = self.coord_to_idx(row, 1)
         end = start + self.cols - 1
-        return b''.join(self.buffer[start:end])
+        return self.buffer[start:end].decode('latin-1')
 
     def current_row(self):
         return self.get_row(self.row + 1)
 
     def clear_line(self):
-        num_items = self.coord_to_idx(self.row + 2, 1) - 1 - self.to_idx()
-        self.buffer[self.to_idx():self.coord_to_idx(self.row + 2, 1) - 1] = [' '] * num_items
+        idx = self.to_idx()
+        end = self.coord_to_idx(self.row + 2, 1) - 1
+        self.buffer[idx:end] = self.blank[idx:end]
+        self.mark_dirty(self.row, self.row)
+
+    def _csi_erase_display(self):
+        if len(self.chars) > 0:
+            self.clear_screen(True)
+            self.set_cursor(1, 1)
+        else:
+            self.clear_screen(False)
+
+    def _csi_erase_line(self):
+        self.clear_line()
+
+    def _csi_sgr(self):
+        if len(self.chars) > 0:
+            self.sgr = int(self.chars)
+        else:
+            self.sgr = 0
+
+    def _csi_cursor_position(self):
+        pos = self.chars.split(b';')
+        self.set_cursor(int(pos[0]), int(pos[1]))
+
+    # Final byte of a CSI escape sequence and its handler
+    CSI_HANDLERS = {
+        b'J': _csi_erase_display,
+        b'K': _csi_erase_line,
+        b'm': _csi_sgr,
+        b'M': _csi_sgr,
+        b'H': _csi_cursor_position,
+    }
+
+    def process(self, chrs):
+        """
+        Apply received terminal output to the screen. Runs of printable characters are copied with a single slice
+        assignment, escape sequences are dispatched through CSI_HANDLERS.
+        """
+        pos = 0
+        length = len(chrs)
+        while pos < length:
+            if self.mode == 0:
+                match = self.TEXT.match(chrs, pos)
+                if match:
+                    self.put_text(chrs[pos:match.end()])
+                    pos = match.end()
+                    continue
+
+                c = chrs[pos:pos + 1]
+                pos += 1
+                if c == self.ESC:
+                    self.mode = 1
+                elif c == self.CR:
+                    self.cr()
+                elif c == self.LF:
+                    self.nl()
+                continue
+
+            c = chrs[pos:pos + 1]
+            if c == self.ESC:
+                # Unfinished escape sequence, start over with the new one
+                self.chars = b''
+                self.mode = 1
+                pos += 1
+            elif self.mode == 1:
+                if c == self.CSI:
+                    self.mode = 2
+                    pos += 1
+                else:
+                    self.mode = 0
+            else:
+                match = self.PARAMETERS.match(chrs, pos)
+                if match:
+                    self.chars += chrs[pos:match.end()]
+                    pos = match.end()
+                    continue
+
+                pos += 1
+                handler = self.CSI_HANDLERS.get(c)
+                if handler is None:
+                    continue
+                try:
+                    handler(self)
+                except (ValueError, IndexError):
+                    print("Error: ", sys.exc_info())
+                self.chars = b''
+                self.mode = 0
+
+    def process_with_echo(self, chrs):
+        """
+        Like process(), echoed bytes still go on the screen but do not mark their row as changed.
+        """
+        pos = 0
+        for idx in self.match_echo(chrs):
+            self.process(chrs[pos:idx])
+            self.quiet = True
+            self.process(chrs[idx:idx + 1])
+            self.quiet = False
+            pos = idx + 1
+        self.process(chrs[pos:])
 
     def running(self):
+        self.flush()
 
         if self.has_bytes_waiting():
             chrs = self.read()
+            self.bytes_read += len(chrs)
             if self.mode == -1:
-                self.buffer += list(chrs)
+                if self.pending_echo:
+                    self.match_echo(chrs)
+                self.raw += chrs
+            elif self.pending_echo:
+                self.process_with_echo(chrs)
             else:
-                for c in chrs:
-                    try:
-                        if c == self.ESC:
-                            if self.mode > 0:
-                                # That is strange, reset and move on to next char
-                                self.reset()
-                                continue
-                            self.mode = 1
-                        elif c == self.CSI and self.mode == 1:
-                            self.mode = 2
-                        elif self.mode == 2:
-                            # we are in escape mode. Handle commands
-                            if c == b'J':
-                                if len(self.chars) > 0:
-                                    self.clear_screen(True)
-                                    self.set_cursor(1, 1)
-                                    self.chars = ''
-                                else:
-                                    self.clear_screen(False)
-                                self.mode = 0
-                            elif c == b'K':
-                                self.clear_line()
-                                self.mode = 0
-                            elif c == b'm' or c == b'M':
-                                if len(self.chars) > 0:
-                                    self.sgr = int(self.chars)
-                                else:
-                                    self.sgr = 0
-                                self.chars = ''
-                                self.mode = 0
-                            elif c == b'H':
-                                pos = self.chars.split(';')
-                                self.set_cursor(int(pos[0]), int(pos[1]))
-                                self.chars = ''
-                                self.mode = 0
-                            elif c in '0123456789;':
-                                self.chars += c
-                            continue
-                        elif c == b'\r':
-                            self.cr()
-                        elif c == b'\n':
-                            self.nl()
-                        else:
-                            self.set_char(c)
-                    except:
-                        print("Error: ", sys.exc_info())
-                        self.reset()
+                self.process(chrs)
+        elif self.pending_echo:
+            self.expire_echo(Scheduler.monotonic())
 
         return self.keep_running
 
     def press_key(self, value):
-        self.serial.write(value)
+        with self.tx_lock:
+            self.tx += value
 
     def key_escape(self):
         self.press_key(b'\033')
@@ -208,17 +623,40 @@ class TermSerial:
     def key_enter(self):
         self.press_key(b'\015')
 
-    def key_up(self):
-        self.press_key(b'\033[A')
+    def key_up(self, count=1):
+        self.press_key(b'\033[A' * count)
+
+    def key_down(self, count=1):
+        self.press_key(b'\033[B' * count)
 
-    def key_down(self):
-        self.press_key(b'\033[B')
+    def fileno(self):
+        """
+        File descriptor of the port to wait on for incoming data, None if the port has none or is read by the
+        reader thread.
+        """
+        if self.reader is None and hasattr(self.serial, 'fileno'):
+            return self.serial.fileno()
+        return None
 
     def close(self):
+        if self.serial is None:
+            return
+        self.flush()
+        self.stop_reader()
         self.serial.close()
+        if self.trace is not None:
+            self.trace.close()
 
     @staticmethod
     def _get_serial(device, baudrate, parity, timeout):
+        if device.startswith('sim://'):
+            # In-process Inventum Ecolution simulator, for tests and benchmarks
+            import Simulator
+            return Simulator.SimulatedPort()
+        if device.startswith('replay:'):
+            # Unit side of a recorded trace, see start_trace()
+            return Trace.open_replay(device)
+
         ser = serial.Serial()
         ser.port = device
         ser.baudrate = baudrate
@@ -227,3 +665,7 @@ class TermSerial:
         ser.write_timeout = 2
         ser.open()
         return ser
+
+
+# Raised by open() and reopen() when the port can not be (re)opened
+PORT_ERRORS = TermSerial.ERRORS + (PortError,)
@@ -0,0 +1,202 @@
+from __future__ import print_function
+
+import logging
+import struct
+import threading
+import time
+
+import serial
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+MAGIC = b'INVTRACE1\n'
+CHUNK = struct.Struct('<dcI')  # seconds since the start of the trace, direction, length of the data that follows
+READ = b'R'
+WRITE = b'W'
+
+
+class TraceWriter(object):
+    """
+    Writes every chunk read from or written to the serial port, with its time, to a trace file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = monotonic()
+
+    def record(self, direction, data):
+        if not data:
+            return
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(CHUNK.pack(monotonic() - self.start, direction, len(data)))
+            self.file.write(data)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_trace(path):
+    """
+    The chunks of a trace file as a list of (seconds, direction, data).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('Not a serial trace: %s' % path)
+
+    chunks = []
+    pos = len(MAGIC)
+    while pos + CHUNK.size <= len(data):
+        at, direction, length = CHUNK.unpack_from(data, pos)
+        pos += CHUNK.size
+        chunks.append((at, direction, data[pos:pos + length]))
+        pos += length
+    return chunks
+
+
+class TracingPort(object):
+    """
+    Wraps a serial port and records everything read from and written to it in a TraceWriter.
+    """
+
+    def __init__(self, port, writer):
+        self.port = port
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.port.timeout = value
+
+    @property
+    def write_timeout(self):
+        return self.port.write_timeout
+
+    @write_timeout.setter
+    def write_timeout(self, value):
+        self.port.write_timeout = value
+
+    def inWaiting(self):
+        return self.port.inWaiting()
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self.writer.record(READ, data)
+        return data
+
+    def write(self, data):
+        written = self.port.write(data)
+        # A non-blocking port may take only part of it
+        self.writer.record(WRITE, data if written is None else data[:written])
+        return written
+
+
+class ReplaySerial(object):
+    """
+    Plays the unit's side of a trace back as a serial port, what is written to it is ignored.
+
+    With a speed > 0 the chunks arrive at their recorded time divided by 'speed', 1 is real time. Speed 0 replays
+    as fast as possible in lockstep: one chunk per poll, and where the trace has a write the replay holds until
+    something is written (or LOCKSTEP_PATIENCE polls passed), so the workflow sees the same order of events.
+    """
+
+    LOCKSTEP_PATIENCE = 20
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.chunks = read_trace(path)
+        self.speed = speed
+        self.timeout = 0
+        self.position = 0
+        self.pending = bytearray()
+        self.start = None
+        self.written = False
+        self.idle_polls = 0
+        self.bytes_written = 0
+
+    @property
+    def finished(self):
+        return self.position >= len(self.chunks) and not self.pending
+
+    def __advance(self):
+        if self.start is None:
+            self.start = monotonic()
+            logging.info('Replaying %d chunks of %s at %s', len(self.chunks), self.path,
+                         '%gx speed' % self.speed if self.speed > 0 else 'full speed')
+
+        chunks = self.chunks
+        if self.speed > 0:
+            elapsed = (monotonic() - self.start) * self.speed
+            while self.position < len(chunks) and chunks[self.position][0] <= elapsed:
+                at, direction, data = chunks[self.position]
+                if direction == READ:
+                    self.pending += data
+                self.position += 1
+            return
+
+        while self.position < len(chunks) and not self.pending:
+            at, direction, data = chunks[self.position]
+            if direction == WRITE:
+                if not self.written and self.idle_polls < self.LOCKSTEP_PATIENCE:
+                    self.idle_polls += 1
+                    return
+                self.written = False
+                self.idle_polls = 0
+            else:
+                self.pending += data
+            self.position += 1
+
+    def inWaiting(self):
+        self.__advance()
+        return len(self.pending)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def read(self, size=1):
+        self.__advance()
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def write(self, data):
+        self.written = True
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flushInput(self):
+        del self.pending[:]
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_replay(device):
+    """
+    ReplaySerial for a device 'replay:<path>' or 'replay:<path>?speed=<n>'.
+    """
+    path, _, query = device[len('replay:'):].partition('?')
+    options = dict(option.partition('=')[::2] for option in query.split('&') if option)
+    try:
+        return ReplaySerial(path, float(options.get('speed', 1)))
+    except (IOError, OSError, ValueError) as e:
+        raise serial.SerialException('Can not replay %s: %s' % (path, e))
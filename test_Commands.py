@@ -0,0 +1,94 @@
+from __future__ import print_function
+
+import unittest
+
+import Commands
+
+
+class FakeInventum(object):
+    """
+    Records what the CommandQueue asked of the unit.
+    """
+    STATE_DATALOGGER = 8
+    STATE_EXTRA_MENU = 5
+
+    def __init__(self):
+        self.calls = []
+        self.current_status = 1
+        self.commands_completed = 0
+        self.state = self.STATE_DATALOGGER
+        self.target_state = self.STATE_DATALOGGER
+
+    def __getattr__(self, name):
+        if name.startswith('set_command_') or name == 'interrupt':
+            return lambda: self.calls.append(name)
+        raise AttributeError(name)
+
+    def start_profile(self, kind, seconds):
+        self.calls.append('%s=%d' % (kind, seconds))
+        return True
+
+
+class CommandQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.acks = []
+        self.queue = Commands.CommandQueue(self.acks.append, clock=lambda: self.now[0])
+        self.inventum = FakeInventum()
+
+    def results(self):
+        return [(ack['command'], ack['result']) for ack in self.acks]
+
+    def test_fan_runs_before_data_and_later_fan_wins(self):
+        self.queue.put('DATA=0')
+        self.queue.put('FAN=1')
+        self.queue.put('FAN=0')
+        self.inventum.current_status = 3
+        self.queue.poll(self.inventum)
+        self.assertEqual(self.inventum.calls, ['set_command_fan_auto'])
+        self.assertEqual(self.results(), [('FAN=1', 'superseded')])
+
+        self.inventum.commands_completed += 1
+        self.queue.poll(self.inventum)
+        self.assertEqual(self.results()[1], ('FAN=0', 'done'))
+        self.assertEqual(self.inventum.calls[-1], 'set_command_data_stop')
+
+    def test_profile_starts_while_a_command_runs(self):
+        self.queue.put('FAN=1')
+        self.queue.poll(self.inventum)
+        self.queue.put('PROFILE=10')
+        self.queue.poll(self.inventum)
+        self.assertEqual(self.inventum.calls, ['set_command_fan_high', 'PROFILE=10'])
+        self.assertEqual(self.queue.active.payload, 'FAN=1')
+
+    def test_immediate_command_taken_by_start_is_not_a_data_command(self):
+        # put() on the MQTT thread may add a PROFILE after the immediate commands were polled
+        command = self.queue.put('MEMTRACE=5')
+        self.queue._CommandQueue__start(self.inventum, command)
+        self.assertEqual(self.inventum.calls, ['MEMTRACE=5'])
+        self.assertIsNone(self.queue.active)
+        self.assertEqual(self.results(), [('MEMTRACE=5', 'done')])
+
+    def test_quit_while_offline(self):
+        self.queue.put('FAN=1')
+        self.queue.put('DATA=1')
+        self.queue.poll_offline(self.inventum)
+        self.assertEqual(self.inventum.calls, [])
+
+        self.queue.put('QUIT')
+        self.queue.poll_offline(self.inventum)
+        self.assertEqual(self.inventum.calls, ['interrupt'])
+        self.assertEqual(self.results(), [('QUIT', 'done'), ('FAN=1', 'cancelled'), ('DATA=1', 'cancelled')])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_timeout(self):
+        self.queue.put('FAN=1')
+        self.queue.poll(self.inventum)
+        self.now[0] += Commands.CommandQueue.TIMEOUT + 1
+        self.queue.poll(self.inventum)
+        self.assertEqual(self.results(), [('FAN=1', 'timeout')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+from __future__ import print_function
+
+import json
+import math
+import struct
+import unittest
+
+import DataLogger
+import Encoding
+
+
+def schema(*names):
+    return DataLogger.Schema(DataLogger.Column(i, name, 'Status') for i, name in enumerate(names))
+
+
+def line(*values):
+    return b','.join(b'0,' + value for value in values)
+
+
+class StructEncoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = schema('a', 'b', 'c')
+        self.encoder = Encoding.StructEncoder()
+
+    def publish(self, *values):
+        record = self.schema.parse(line(*values))
+        description = self.encoder.schema(record)
+        payload = self.encoder.encode(record)
+        layout = json.loads(description) if description else None
+        if layout is not None:
+            self.layout = layout
+        unpacked = struct.unpack(self.layout['format'], payload)
+        self.assertEqual(unpacked[0], self.layout['id'])
+        return layout, dict(zip(self.layout['fields'], unpacked[1:]))
+
+    def test_int_column_widened_to_float(self):
+        layout, values = self.publish(b'21', b'1', b'x')
+        self.assertEqual(layout['format'], '<Iii')
+        self.assertEqual(values, {'a': 21, 'b': 1})
+
+        layout, values = self.publish(b'21.5', b'2', b'y')
+        self.assertEqual(layout['format'], '<Ifi')
+        self.assertEqual(values, {'a': 21.5, 'b': 2})
+
+        layout, values = self.publish(b'22', b'3', b'z')
+        self.assertIsNone(layout)
+        self.assertEqual(values, {'a': 22.0, 'b': 3})
+
+    def test_int32_overflow_is_missing(self):
+        self.publish(b'1', b'2', b'x')
+        layout, values = self.publish(b'99999999999', b'-99999999999', b'x')
+        self.assertIsNone(layout)
+        self.assertEqual(values, {'a': Encoding.StructEncoder.MISSING_INT, 'b': Encoding.StructEncoder.MISSING_INT})
+
+    def test_empty_column_joins_the_layout_later(self):
+        layout, values = self.publish(b'1', b'', b'x')
+        self.assertEqual(layout['fields'], ['a'])
+
+        layout, values = self.publish(b'2', b'3.5', b'x')
+        self.assertEqual(layout['fields'], ['a', 'b'])
+        self.assertEqual(values, {'a': 2, 'b': 3.5})
+
+    def test_value_that_does_not_convert_is_missing(self):
+        self.publish(b'1', b'2.5', b'x')
+        layout, values = self.publish(b'-', b'-', b'x')
+        self.assertEqual(values['a'], Encoding.StructEncoder.MISSING_INT)
+        self.assertTrue(math.isnan(values['b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
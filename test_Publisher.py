@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+import json
+import unittest
+
+import DataLogger
+import Publisher
+import Scheduler
+from test_Scheduler import FakeClock
+
+
+class RecordingClient(object):
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages.append((topic, payload))
+
+    def topics(self):
+        return [topic for topic, _ in self.messages]
+
+
+def records(*values):
+    schema = DataLogger.Schema([DataLogger.Column(0, 'Temp_buiten', 'Status')])
+    return [schema.parse(b'0,' + value) for value in values]
+
+
+class AggregatePublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = Scheduler.Scheduler(self.clock)
+        self.client = RecordingClient()
+        self.publisher = Publisher.AggregatePublisher(self.client, 'inventum', [60], scheduler=self.scheduler)
+
+    def test_window_is_published_by_its_timer(self):
+        for record in records(b'10', b'20'):
+            self.publisher.publish(record)
+        self.assertEqual(self.client.messages, [])
+
+        self.clock.advance(60)
+        self.scheduler.run_due()
+        self.assertEqual(self.client.topics(), ['inventum/agg/1m'])
+        aggregate = json.loads(self.client.messages[0][1])
+        self.assertEqual(aggregate['count'], 2)
+        self.assertEqual(aggregate['data']['Temp_buiten']['mean'], 15)
+        self.assertNotIn('partial', aggregate)
+
+        self.publisher.flush()
+        self.assertEqual(len(self.client.messages), 1)
+
+    def test_without_a_scheduler_the_next_record_publishes(self):
+        publisher = Publisher.AggregatePublisher(self.client, 'inventum', [60])
+        publisher.clock = self.clock
+        first, second = records(b'10', b'20')
+        publisher.publish(first)
+        self.clock.advance(60)
+        publisher.publish(second)
+        self.assertEqual(json.loads(self.client.messages[0][1])['count'], 1)
+
+        publisher.flush()
+        self.assertTrue(json.loads(self.client.messages[1][1])['partial'])
+
+
+class ChangePublisherTest(unittest.TestCase):
+
+    def test_heartbeat_on_the_given_clock(self):
+        clock = FakeClock()
+        client = RecordingClient()
+        publisher = Publisher.ChangePublisher(client, 'inventum', heartbeat=300, clock=clock)
+        for record in records(b'10', b'10'):
+            publisher.publish(record)
+        self.assertEqual(len(client.messages), 1)
+
+        clock.advance(300)
+        publisher.publish(records(b'10')[0])
+        self.assertEqual(client.topics(), ['inventum/data/Temp_buiten'] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
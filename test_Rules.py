@@ -0,0 +1,152 @@
+from __future__ import print_function
+
+import logging
+import unittest
+
+import DataLogger
+import Inventum
+import Rules
+import Scheduler
+from test_Scheduler import FakeClock
+
+
+def schema(*names):
+    return DataLogger.Schema(DataLogger.Column(i, name, 'Status') for i, name in enumerate(names))
+
+
+class ActionRecorder(object):
+    def __init__(self):
+        self.actions = []
+
+    def set_command_fan_high(self):
+        self.actions.append('FAN=1')
+
+    def set_command_fan_auto(self):
+        self.actions.append('FAN=0')
+
+
+class RuleParseTest(unittest.TestCase):
+
+    def test_parse(self):
+        rule = Rules.Rule.parse('humid', ' Vocht_afvoer >= 70.5 for 120 -> fan=1 ')
+        self.assertEqual((rule.left, rule.sign, rule.right), ('Vocht_afvoer', None, None))
+        self.assertEqual((rule.threshold, rule.duration, rule.action), (70.5, 120.0, 'FAN=1'))
+        self.assertEqual(rule.text, 'Vocht_afvoer >= 70.5 for 120 -> fan=1')
+
+    def test_parse_difference_of_fields(self):
+        rule = Rules.Rule.parse('exhaust', 'Temp_afvoer - Temp_buiten < -5 -> FAN=0')
+        self.assertEqual((rule.left, rule.sign, rule.right), ('Temp_afvoer', '-', 'Temp_buiten'))
+        self.assertEqual((rule.threshold, rule.duration), (-5.0, 0.0))
+        self.assertEqual(rule.fields, ('Temp_afvoer', 'Temp_buiten'))
+
+    def test_field_names_with_a_dash(self):
+        rule = Rules.Rule.parse('fan', '3-standen == 3 -> FAN=0')
+        self.assertEqual((rule.left, rule.sign), ('3-standen', None))
+
+    def test_invalid(self):
+        for text in ('Vocht_afvoer > -> FAN=1', 'Vocht_afvoer => 70 -> FAN=1', 'Vocht_afvoer <> 70 -> FAN=1',
+                     'Vocht_afvoer > 70', 'Vocht_afvoer > 70 for x -> FAN=1', '> 70 -> FAN=1'):
+            self.assertRaises(ValueError, Rules.Rule.parse, 'bad', text)
+
+    def test_unknown_action(self):
+        self.assertRaises(ValueError, Rules.Rule.parse, 'bad', 'Vocht_afvoer > 70 -> DATA=1')
+
+    def test_unknown_field_never_holds(self):
+        rule = Rules.Rule.parse('missing', 'Vocht_boven > 70 -> FAN=1')
+        header = schema('Vocht_afvoer')
+        self.assertFalse(rule.bind(header))
+        self.assertFalse(rule.check(header.parse(b'0,99').values, 0))
+
+
+class RuleCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = schema('Vocht_afvoer', 'Temp_afvoer', 'Temp_buiten')
+        self.clock = FakeClock(0.0)
+        self.target = ActionRecorder()
+
+    def record(self, *values):
+        return self.schema.parse(b','.join(b'0,' + value for value in values))
+
+    def feed(self, engine, values, seconds=10):
+        fired = []
+        for value in values:
+            self.clock.advance(seconds)
+            fired.append([rule.name for rule in engine.evaluate(self.record(value, b'20', b'10'), self.target)])
+        return fired
+
+    def test_fires_once_after_its_duration(self):
+        engine = Rules.create([('humid', 'Vocht_afvoer > 70 for 30 -> FAN=1')], clock=self.clock)
+        fired = self.feed(engine, [b'60', b'75', b'75', b'75', b'75', b'75', b'75'])
+        self.assertEqual(fired, [[], [], [], [], ['humid'], [], []])
+        self.assertEqual(self.target.actions, ['FAN=1'])
+        self.assertTrue(engine.active('FAN=1'))
+        self.assertFalse(engine.active('FAN=0'))
+
+    def test_duration_starts_again_when_the_condition_breaks(self):
+        engine = Rules.create([('humid', 'Vocht_afvoer > 70 for 30 -> FAN=1')], clock=self.clock)
+        fired = self.feed(engine, [b'75', b'75', b'75', b'65', b'75', b'75', b'75', b'75'])
+        self.assertEqual(fired, [[], [], [], [], [], [], [], ['humid']])
+
+    def test_rearms_after_the_condition_cleared(self):
+        engine = Rules.create([('humid', 'Vocht_afvoer > 70 -> FAN=1')], clock=self.clock)
+        fired = self.feed(engine, [b'75', b'75', b'60', b'75', b'75'])
+        self.assertEqual(fired, [['humid'], [], [], ['humid'], []])
+        self.assertEqual(self.target.actions, ['FAN=1', 'FAN=1'])
+
+    def test_hysteresis_pair(self):
+        engine = Rules.create([('humid', 'Vocht_afvoer > 70 -> FAN=1'), ('dry', 'Vocht_afvoer < 60 -> FAN=0')],
+                              clock=self.clock)
+        self.feed(engine, [b'75', b'65', b'55', b'65', b'75'])
+        self.assertEqual(self.target.actions, ['FAN=1', 'FAN=0', 'FAN=1'])
+
+    def test_difference(self):
+        engine = Rules.create([('exhaust', 'Temp_afvoer - Temp_buiten >= 10 -> FAN=1')], clock=self.clock)
+        self.clock.advance(10)
+        self.assertEqual(engine.evaluate(self.record(b'60', b'19', b'10'), self.target), [])
+        self.assertEqual(len(engine.evaluate(self.record(b'60', b'20', b'10'), self.target)), 1)
+
+    def test_text_value_never_holds(self):
+        engine = Rules.create([('humid', 'Vocht_afvoer > 70 -> FAN=1')], clock=self.clock)
+        self.feed(engine, [b'75'])
+        self.assertEqual(self.feed(engine, [b'-', b'75']), [[], ['humid']])
+
+
+class RuleFanResetTest(unittest.TestCase):
+    """
+    A FAN=1 rule and the fan reset after 'reset_after' minutes, against the simulator.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.inventum = Inventum.Inventum(logging.getLogger('test'), 'sim://', 20,
+                                          scheduler=Scheduler.Scheduler(self.clock))
+        self.device = self.inventum.termser.serial.device
+        self.device.clock = self.clock
+        self.device.rate = 0.1
+        self.inventum.begin()
+
+    def tearDown(self):
+        self.inventum.termser.close()
+
+    def run_for(self, seconds, step=1.0):
+        end = self.clock.now + seconds
+        while self.clock.now < end:
+            self.clock.advance(step)
+            self.inventum.run_once()
+
+    def test_fan_stays_high_while_a_rule_holds(self):
+        self.inventum.rules = Rules.create([('always', 'Temp_buiten > -1000 -> FAN=1')], clock=self.clock)
+        self.run_for(20)
+        self.assertEqual(self.inventum.current_status, 3)
+
+        self.run_for(20 * 60 + 30)
+        self.assertEqual(self.inventum.current_status, 3)
+
+        self.inventum.rules = None
+        self.run_for(20 * 60 + 30)
+        self.assertNotEqual(self.inventum.current_status, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+from __future__ import print_function
+
+import logging
+import unittest
+
+import Inventum
+import Scheduler
+
+
+class FakeClock(object):
+    """
+    A clock that only moves when the test says so.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = Scheduler.Scheduler(self.clock)
+        self.fired = []
+
+    def test_runs_due_timers_in_deadline_order(self):
+        self.scheduler.call_later(3, self.fired.append, 'c')
+        self.scheduler.call_later(1, self.fired.append, 'a')
+        self.scheduler.call_later(2, self.fired.append, 'b')
+        self.scheduler.call_later(2, self.fired.append, 'b2')
+
+        self.clock.advance(2)
+        self.assertEqual(self.scheduler.run_due(), 3)
+        self.assertEqual(self.fired, ['a', 'b', 'b2'])
+        self.assertEqual(len(self.scheduler), 1)
+
+        self.clock.advance(1)
+        self.assertEqual(self.scheduler.run_due(), 1)
+        self.assertEqual(self.fired, ['a', 'b', 'b2', 'c'])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_cancelled_timer_does_not_run(self):
+        timer = self.scheduler.call_later(1, self.fired.append, 'a')
+        self.scheduler.call_later(2, self.fired.append, 'b')
+        timer.cancel()
+        timer.cancel()
+        self.assertEqual(len(self.scheduler), 1)
+
+        self.clock.advance(5)
+        self.assertEqual(self.scheduler.run_due(), 1)
+        self.assertEqual(self.fired, ['b'])
+        self.assertEqual(self.scheduler.cancelled, 0)
+
+    def test_cancel_after_firing_is_ignored(self):
+        timer = self.scheduler.call_later(1, self.fired.append, 'a')
+        self.clock.advance(1)
+        self.scheduler.run_due()
+        timer.cancel()
+        self.assertEqual(self.scheduler.cancelled, 0)
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_timeout(self):
+        self.assertIsNone(self.scheduler.timeout())
+        self.assertEqual(self.scheduler.timeout(30), 30)
+
+        timer = self.scheduler.call_later(5, self.fired.append, 'a')
+        self.assertEqual(self.scheduler.timeout(), 5)
+        self.assertEqual(self.scheduler.timeout(2), 2)
+        self.clock.advance(7)
+        self.assertEqual(self.scheduler.timeout(), 0)
+
+        timer.cancel()
+        self.assertEqual(self.scheduler.timeout(30), 30)
+        self.assertEqual(self.scheduler.cancelled, 0)
+
+    def test_rebuild_from_a_callback(self):
+        # Cancelling most timers and adding one from a callback rebuilds the heap while run_due() walks it
+        timers = [self.scheduler.call_later(10, self.fired.append, i) for i in range(100)]
+
+        def cancel_all():
+            for timer in timers:
+                timer.cancel()
+            self.scheduler.call_later(0, self.fired.append, 'new')
+
+        self.scheduler.call_later(1, cancel_all)
+        self.scheduler.call_later(2, self.fired.append, 'b')
+        self.clock.advance(2)
+        self.assertEqual(self.scheduler.run_due(), 3)
+        self.assertEqual(self.fired, ['b', 'new'])
+        self.assertEqual(self.scheduler.cancelled, 0)
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertEqual(self.scheduler.heap, [])
+
+
+class InventumTimerTest(unittest.TestCase):
+    """
+    The timeouts of the state machine against the simulator, on a clock the test moves.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.inventum = Inventum.Inventum(logging.getLogger('test'), 'sim://', 20,
+                                          scheduler=Scheduler.Scheduler(self.clock))
+        self.device = self.inventum.termser.serial.device
+        self.device.clock = self.clock
+        self.device.rate = 0.1
+        self.inventum.begin()
+
+    def tearDown(self):
+        self.inventum.termser.close()
+
+    def run_for(self, seconds, step=1.0):
+        end = self.clock.now + seconds
+        while self.clock.now < end:
+            self.clock.advance(step)
+            self.inventum.run_once()
+
+    def test_datalogger_silence_restarts_the_datalogger(self):
+        self.run_for(5)
+        self.assertEqual(self.inventum.state, Inventum.Inventum.STATE_DATALOGGER)
+
+        resets = []
+        self.inventum.datalogger.reset = lambda: resets.append(self.clock.now)
+        self.device.rate = 0
+        self.run_for(Inventum.Inventum.DATALOGGER_TIMEOUT + 10)
+        self.assertTrue(resets)
+
+    def test_fan_is_reset_after_reset_minutes(self):
+        self.run_for(5)
+        self.inventum.set_command_fan_high()
+        self.run_for(20)
+        self.assertEqual(self.inventum.current_status, 3)
+
+        self.run_for(20 * 60 + 30)
+        self.assertNotEqual(self.inventum.current_status, 3)
+        self.assertEqual(self.inventum.state, Inventum.Inventum.STATE_DATALOGGER)
+
+    def test_sleeps_until_the_next_deadline(self):
+        self.run_for(5)
+        # Only the next record and the timeouts, no polling tick
+        self.assertGreater(self.inventum.timeout(), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()